@@ -33,17 +33,26 @@ Options:
 
 -f <json> [-- args] Path to the file created with image2json. Remaing args
                     will be passed to fastboot.
+-b <json>           Delta mode. Path to the image2json file the device was
+                    last provisioned from. Only chunks whose digests differ
+                    are written; images with no changes are skipped. Both
+                    files need digests (image2json -d) with the same chunk
+                    size, otherwise images are written in full.
 EOF
 }
 
 
 JSON=
+BASE=
 FARGS=
-while getopts "f:" flag ; do
+while getopts "f:b:" flag ; do
    case "$flag" in
       f)
          JSON="$OPTARG"
          ;;
+      b)
+         BASE="$OPTARG"
+         ;;
       *|?)
          usage ; exit 1
          ;;
@@ -51,6 +60,7 @@ while getopts "f:" flag ; do
 done
 [[ -z $JSON ]] && { usage ; die "Require path to JSON file" ; }
 realpath -e $JSON > /dev/null 2>&1 || die "$JSON is invalid"
+[[ -z $BASE ]] || realpath -e $BASE > /dev/null 2>&1 || die "$BASE is invalid"
 
 shift $((OPTIND - 1))
 FARGS=("$@")
@@ -79,6 +89,23 @@ if [ "${#FARGS[@]}" -eq 0 ]; then
 ASSET_DIR=$(pmap -f $JSON --get-key IGmeta.IGconf_image_outputdir)
 [[ -d $ASSET_DIR ]] || die "JSON specified asset dir $ASSET_DIR is invalid"
 
+# Delta plan: image name -> file to flash, or nothing if unchanged
+declare -A DELTA=()
+if [[ -n $BASE ]] ; then
+   DELTA_DIR=$(mktemp -d) || die "mktemp"
+   trap 'rm -rf "$DELTA_DIR"' EXIT
+   msg "Computing delta against $BASE.."
+   plan=$(idp-delta --base "$BASE" --new "$JSON" --out "$DELTA_DIR" --assets "$ASSET_DIR") \
+      || die "Unable to compute delta"
+   while read -r name kind file bytes ; do
+      case $kind in
+         unchanged) DELTA[$name]= ; msg "$name: unchanged" ;;
+         delta)     DELTA[$name]=$file ; msg "$name: $bytes bytes changed" ;;
+      esac
+   done <<< "$plan"
+fi
+
+
 # Do it
 
 msg "Staging description.."
@@ -105,6 +132,14 @@ while true; do
         if [[ "$line" =~ ^\(bootloader\)\ ([^:]+):(.+)$ ]]; then
             dev="${BASH_REMATCH[1]}"
             image="${BASH_REMATCH[2]}"
+            if [[ -v DELTA[$image] ]] ; then
+               if [[ -z ${DELTA[$image]} ]] ; then
+                  msg "Skipping $dev, $image unchanged"
+                  continue
+               fi
+               FB flash $dev ${DELTA[$image]} || die "Error writing $image delta to $dev"
+               continue
+            fi
             FB flash $dev ${ASSET_DIR}/$image || die "Error writing $image to $dev"
         fi
     done <<< "$info_resp"
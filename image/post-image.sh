@@ -27,19 +27,23 @@ if [ "${IGconf_image_provider:-}" = "genimage" ] && [ -f ${1}/genimage.cfg ] ; t
       fi
    done
 
+   # Per-partition content digests for verification and delta writes
+   if [ "${IGconf_image_idp_digest_chunk:-0}" != 0 ] ; then
+      opts+=('-d' "$IGconf_image_idp_digest_chunk")
+   fi
+
    # Generate the IDP doc
    image2json -g ${1}/genimage.cfg "${opts[@]}" > ${1}/image.json ||
       die "IDP: Doc generation failed."
 
-   # Validate IDP doc against IDP schema
-   pmap --schema "$IGconf_image_idp_schema" --file "${1}/image.json" ||
-      die "IDP: Image Description Provisioning doc failed validation."
-
-   # Validate spliced PMAP within the IDP doc against the PMAP schema
+   # Validate IDP doc against IDP schema, and the spliced PMAP within it
+   # against the PMAP schema, in one pass
+   schemas=(--schema "$IGconf_image_idp_schema")
    if $pmap_installed ; then
-      pmap --schema "$IGconf_image_pmap_schema" --file "${1}/image.json" ||
-         die "IDP: Merged PMAP failed validation."
+      schemas+=(--schema "$IGconf_image_pmap_schema")
    fi
+   pmap "${schemas[@]}" --file "${1}/image.json" ||
+      die "IDP: Image Description Provisioning doc or merged PMAP failed validation."
 fi
 
 
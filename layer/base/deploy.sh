@@ -30,53 +30,30 @@ files+=("${IGconf_target_dir}/manifest")
 files+=("${IGconf_target_dir}/config.yaml")
 
 
-echo "Installing assets..."
-mkdir -p "$IGconf_deploy_dir"
-for f in "${files[@]}" ; do
-   [[ -f "$f" ]] || continue
-   case "$IGconf_deploy_compression" in
-      zstd)
-         zstd -v -f "$f" --sparse --output-dir-flat "$IGconf_deploy_dir"
-         ;;
-      none)
-         cp -v --sparse=always "$f" "$IGconf_deploy_dir"
-         ;;
-      *)
-         ;;
-   esac
-done
-
-
-echo "Creating manifest..."
-{
-  echo "{"
-  echo "  \"deployment_info\": {"
-  echo "    \"version\": \"${IGconf_artefact_version:-}\","
-  echo "    \"date\": \"$(date -Iseconds)\""
-  echo "  },"
-  echo "  \"files\": ["
-
-  first=true
-  for f in "$IGconf_deploy_dir"/*; do
-    [[ -f "$f" ]] || continue
-    [[ "$(basename "$f")" == "deployed.json" ]] && continue
-    [[ "$first" == true ]] || echo ","
-    first=false
+# zstd settings shared by the assets and the IDP archive
+zopts=( "-${IGconf_deploy_compression_level:-3}" "-T${IGconf_deploy_compression_threads:-0}" )
+if [[ ${IGconf_deploy_compression_long:-0} != 0 ]] ; then
+   zopts+=( "--long=${IGconf_deploy_compression_long}" )
+fi
 
-    size=$(stat -c %s "$f")
-    mime_type=$(file -b --mime-type "$f" 2>/dev/null || echo "unknown")
 
-    echo "    {"
-    echo "      \"name\": \"$(basename "$f")\","
-    echo "      \"size\": $size,"
-    echo "      \"mime_type\": \"$mime_type\","
-    echo "      \"sha1\": \"$(sha1sum "$f" | cut -d' ' -f1)\""
-    echo "    }"
-  done
+echo "Installing assets..."
+mkdir -p "$IGconf_deploy_dir"
+case "$IGconf_deploy_compression" in
+   zstd|none)
+      opts=( --compression "$IGconf_deploy_compression" )
+      opts+=( --level "${IGconf_deploy_compression_level:-3}" )
+      opts+=( --threads "${IGconf_deploy_compression_threads:-0}" )
+      opts+=( --long "${IGconf_deploy_compression_long:-0}" )
+      opts+=( --manifest "$IGconf_deploy_dir/deployed.json" )
+      opts+=( --version "${IGconf_artefact_version:-}" )
+      [[ ${IGconf_deploy_manifest_sha1:-y} == y ]] && opts+=( --sha1 )
+      deploy-assets "${opts[@]}" "$IGconf_deploy_dir" "${files[@]}"
+      ;;
+   *)
+      ;;
+esac
 
-  echo "  ]"
-  echo "}"
-} > "$IGconf_deploy_dir/deployed.json"
 
 # Create a .tar.zst IDP archive suitable for upload to rpi-sb-provisioner.
 # Bundles uncompressed image.json + sparse images at the top level of the tar.
@@ -90,6 +67,6 @@ if [[ "$IGconf_deploy_compression" == "zstd" ]] && [[ -f "${IGconf_image_outputd
 
     archive_name="${IGconf_image_name:-image}-${IGconf_artefact_version:-unknown}.tar.zst"
     tar -C "${IGconf_image_outputdir}" -cf - "${idp_files[@]}" \
-        | zstd -f -o "$IGconf_deploy_dir/$archive_name"
+        | zstd -q -f "${zopts[@]}" -o "$IGconf_deploy_dir/$archive_name"
     echo "Created IDP archive: $IGconf_deploy_dir/$archive_name"
 fi
@@ -79,18 +79,45 @@ runenv() {
 export -f runenv
 
 
-# Retrieve a variable from a file containing key value pairs
-get_var() {
-   local key="$1" file="$2"
-   local line value
-
-   if line=$(grep "^${key}=" "$file" 2>/dev/null); then
-      value="${line#*=}"
-      value="${value#\"}"
-      value="${value%\"}"
-      [[ -n "$value" ]] && { echo "$value"; return 0; }
-   fi
-   return 1
+# Time a command. If IG_TRACE_LOG is set, append a span record for it
+# (name, category, start us, end us, pid, rc). See ig timing.
+span() {
+   local name=$1 cat=$2; shift 2
+   [[ -n ${IG_TRACE_LOG:-} ]] || { "$@"; return; }
+   local t0=${EPOCHREALTIME//[.,]/} rc
+   "$@"
+   rc=$?
+   printf '%s\t%s\t%s\t%s\t%s\t%s\n' "$name" "$cat" "$t0" \
+      "${EPOCHREALTIME//[.,]/}" "$BASHPID" "$rc" >> "$IG_TRACE_LOG"
+   return $rc
+}
+export -f span
+
+
+# Load a file of key=value pairs into an associative array (by name) in one
+# pass, so lookups don't rescan the file. Blank lines and comments are
+# skipped, surrounding double quotes are stripped. Fails on any line that is
+# not a valid assignment.
+load_env() {
+   local file=$1
+   local -n _env=$2
+   local line key val n=0
+   [[ -r $file ]] || { err "load_env: cannot read $file" ; return 1 ;}
+   _env=()
+   while IFS= read -r line || [[ -n $line ]]; do
+      ((n++))
+      [[ $line =~ ^[[:space:]]*(#|$) ]] && continue
+      if [[ ! $line =~ ^[A-Za-z_][A-Za-z0-9_]*= ]]; then
+         err "load_env: $file:$n: not a key=value assignment"
+         return 1
+      fi
+      key=${line%%=*}
+      val=${line#*=}
+      if [[ ${#val} -ge 2 && $val == \"*\" ]]; then
+         val=${val:1:-1}
+      fi
+      _env[$key]=$val
+   done < "$file"
 }
 
 
@@ -107,7 +134,7 @@ mapfile_kv() {
 
    [[ -r $file ]] || die "$0 cannot read $file"
 
-   # FIXME use get_var
+   # Pairs are passed on in file order. Use load_env for lookups by key.
    while IFS= read -r line || [[ -n $line ]]; do
       key=${line%%=*}
       val=${line#*=}
@@ -226,6 +253,36 @@ map_path() {
 export -f map_path
 
 
+# Take a reference on a shared cache directory (see ig cache) for the rest of
+# this shell's lifetime, or until cache_unref_all. The shared lock is held on
+# an fd inherited by every child, so eviction waits for the whole build.
+# $1 = cache directory
+# $2 = optional description recorded with the reference
+declare -gA _CACHE_REFS=()
+cache_ref() {
+   local dir fd
+   dir=$(realpath -e "$1") || return 1
+   [[ -v _CACHE_REFS[$dir] ]] && return 0
+   mkdir -p "${dir}/.igcache/refs" || return 1
+   exec {fd}>>"${dir}/.igcache/lock" || return 1
+   flock -s "$fd" || return 1
+   echo "${2:-rpi-image-gen}" > "${dir}/.igcache/refs/$$"
+   _CACHE_REFS[$dir]=$fd
+}
+
+
+# Drop every reference taken with cache_ref
+cache_unref_all() {
+   local dir fd
+   for dir in "${!_CACHE_REFS[@]}"; do
+      fd=${_CACHE_REFS[$dir]}
+      rm -f "${dir}/.igcache/refs/$$"
+      exec {fd}>&-
+      unset "_CACHE_REFS[$dir]"
+   done
+}
+
+
 # Write out a layer's pre config in mmdebstrap keyed YAML at the given path.
 # Optional. Loaded immediately before the layer's own YAML. Use to influence
 # the order of operations when bdebstrap merges all YAML prior to mmdebstrap
@@ -234,13 +291,12 @@ export -f map_path
 # $2 = layer version
 # $3 = layer's static YAML path
 # $4 = path to write the synthesised file to
+# $5 = layer's rootfs overlay dir from the build plan (empty if none)
 synth_layer_pre() {
-   local name=$1 version=$2 layer=$3 out=$4
-   local stem=${layer%.yaml}
+   local name=$1 version=$2 layer=$3 out=$4 overlay=${5:-}
    local hooks=()
 
-   local overlay="${stem}.rootfs-overlay"
-   [[ -d $overlay ]] && hooks+=( "rsync -a --exclude='.keep' --exclude='.empty' \"$overlay/\" \"\$1/\"" )
+   [[ -n $overlay ]] && hooks+=( "overlay \"\$1\" \"$overlay\"" )
 
    [[ ${#hooks[@]} -gt 0 ]] || return 0
 
@@ -257,6 +313,34 @@ synth_layer_pre() {
 export -f synth_layer_pre
 
 
+# Write out the mmdebstrap keyed YAML that adds the indexed apt cache as a
+# source for the duration of the build. It is pinned at the default priority
+# so apt still picks the newest version on offer and the cache only serves
+# versions the mirrors also have. The cache is bind mounted at
+# its host path so the same file:// URI works inside and outside the chroot.
+# Everything is removed again before the image is finalised.
+# $1 = apt cache directory (absolute)
+# $2 = path to write the synthesised file to
+synth_apt_cache_repo() {
+   local cache=$1 out=$2
+   local list=/etc/apt/sources.list.d/00-ig-aptcache.list
+   local pref=/etc/apt/preferences.d/00-ig-aptcache
+   local lists="/var/lib/apt/lists/${cache//\//_}_._"
+   cat > "$out" <<EOF
+mmdebstrap:
+  setup-hooks:
+    - 'mkdir -p "\$1${cache}" && mount --bind "${cache}" "\$1${cache}"'
+    - 'mkdir -p "\$1${list%/*}" "\$1${pref%/*}"'
+    - 'echo "deb [trusted=yes] file://${cache} ./" > "\$1${list}"'
+    - 'printf "Package: *\\nPin: release o=rpi-image-gen\\nPin-Priority: 500\\n" > "\$1${pref}"'
+  cleanup-hooks:
+    - 'rm -f "\$1${list}" "\$1${pref}" "\$1${lists}"*'
+    - 'umount "\$1${cache}" && rmdir -p --ignore-fail-on-non-empty "\$1${cache}"'
+EOF
+}
+export -f synth_apt_cache_repo
+
+
 # Write out a layer's post config in mmdebstrap keyed YAML at the given path.
 # Optional. Loaded immediately after the layer's own YAML. Use to influence
 # the order of operations when bdebstrap merges all YAML prior to mmdebstrap
@@ -271,48 +355,6 @@ synth_layer_post() {
 export -f synth_layer_post
 
 
-# Filters a layer plan down to layers that declare an mmdebstrap: mapping.
-filter_mmdebstrap_layers() {
-   python3 -c '
-import sys, pathlib, yaml
-for raw in pathlib.Path(sys.argv[1]).read_text().splitlines():
-    if not raw or raw.startswith("#"):
-        continue
-    parts = raw.split(":", 3)
-    if len(parts) != 4 or not parts[0] or not parts[3]:
-        continue
-    layer, version, static, resolved = parts
-    try:
-        data = yaml.safe_load(open(resolved, "rb"))
-    except Exception as e:
-        print(f"{resolved}: {e}", file=sys.stderr)
-        sys.exit(2)
-    if isinstance(data, dict) and data.get("mmdebstrap"):
-        print(f"{layer}:{version}:{static}:{resolved}")
-' "$1"
-}
-export -f filter_mmdebstrap_layers
-
-
-# General purpose key=value normaliser that escapes characters that would
-# break shell expansion.
-safe_kv() {
-  python3 - "$1" <<'PY'
-import sys
-import re
-with open(sys.argv[1], encoding='utf-8') as src:
-   for raw in src:
-      line = raw.rstrip('\n')
-      if not line or line.lstrip().startswith('#') or '=' not in line:
-         print(line)
-         continue
-      key, value = line.split('=', 1)
-      value = value.replace('\\', '\\\\').replace('"', '\\"').replace('`', '\\`')
-      # Permits ${var} or $(cmd) expansion, escapes $6$salt$hash
-      value = re.sub(r'\$(?![({])', r'\\$', value)
-      print(f'{key}="{value}"')
-PY
-}
 
 
 checkpath_world_exec() {
@@ -14,14 +14,15 @@ readonly -a IG_TOOLS_REGISTRY=(
    "IG_ENABLE_HOST_EROFS_UTILS|y|erofs-utils"
 )
 
+# $1 = name of the associative array holding the build env (see load_env)
 collect_build_deps() {
-   local envfile="${1:?missing env file}"
+   local -n _cfg="${1:?missing env array}"
    local packages=
    local var value pkg
 
    for entry in "${IG_TOOLS_REGISTRY[@]}"; do
       IFS='|' read -r var value pkg <<< "$entry"
-      if value_read=$(get_var "$var" "$envfile") && [[ "$value_read" == "$value" ]]; then
+      if [[ "${_cfg[$var]:-}" == "$value" ]]; then
          packages+=("$pkg")
       fi
    done
@@ -34,12 +35,12 @@ bootstrap_build_tools() {
    : "${IGconf_sys_workroot?missing IGconf_sys_workroot}"
    : "${DEB_BUILD_GNU_TYPE?missing DEB_BUILD_GNU_TYPE}"
 
-   local tools=( $(collect_build_deps "${ctx[FINALENV]}") )
+   local tools=( $(collect_build_deps cfg) )
    local destdir="${IGconf_sys_workroot}/${DEB_BUILD_GNU_TYPE}"
    local prefix=/usr
    local start=$SECONDS
 
-   runenv "${ctx[FINALENV]}" \
+   span build-tools step runenv "${ctx[FINALENV]}" \
       make -s -j"$(nproc)" -C "${IGTOP}/package" "${tools[@]}" \
       PKG_DESTDIR="$destdir" PKG_PREFIX="$prefix"
 
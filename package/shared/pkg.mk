@@ -130,7 +130,7 @@ ifeq ($(PKG_BUILD_SCHEME),pysrc)
 
 # https://github.com/pypa/pip/issues/10978
 define installwheel
-	$(call run,env $(PKG_ENVIRONMENT) \
+	$(call run,$(PIP_LOCK) env $(PKG_ENVIRONMENT) \
 		python3 -m pip install \
 			$(PIP_ARGS) \
 			--find-links $(PIP_WHEELS) \
@@ -144,6 +144,13 @@ endef
 PIP_CACHE  := $(PKG_CACHE_ROOT)/pip-cache
 PIP_WHEELS := $(PKG_CACHE_ROOT)/pip-wheels
 
+# Hold the shared cache while pip uses it, see ig cache. The /tmp fallback
+# is not a managed cache.
+ifneq ($(strip $(IGconf_sys_cachedir)),)
+PIP_LOCK_DIR := $(PKG_CACHE_ROOT)/.igcache
+PIP_LOCK     := flock -s $(PIP_LOCK_DIR)/lock
+endif
+
 PKG_ENVIRONMENT += PIP_CACHE_DIR=$(PIP_CACHE)
 PKG_ENVIRONMENT += PIP_PREFER_BINARY=1
 
@@ -153,12 +160,12 @@ PKG_ENVIRONMENT += PIP_NO_INDEX=1
 PKG_ENVIRONMENT += PIP_FIND_LINKS=$(PIP_WHEELS)
 endif
 
-$(PKG_CACHE_ROOT) $(PIP_CACHE) $(PIP_WHEELS):
+$(PIP_LOCK_DIR) $(PIP_CACHE) $(PIP_WHEELS):
 	@mkdir -p $@
 
-$(PKG_BUILD_STAMP): $(PKG_SOURCE_STAMP) | $(PIP_CACHE) $(PIP_WHEELS)
+$(PKG_BUILD_STAMP): $(PKG_SOURCE_STAMP) | $(PIP_LOCK_DIR) $(PIP_CACHE) $(PIP_WHEELS)
 	$(call msg,BUILD)
-	@$(call run,env $(PKG_ENVIRONMENT) \
+	@$(call run,$(PIP_LOCK) env $(PKG_ENVIRONMENT) \
 		python3 -m pip wheel $(PIP_ARGS) --wheel-dir $(PIP_WHEELS) $(PKG_SOURCE_PATH))
 	@touch $@
 
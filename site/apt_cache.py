@@ -0,0 +1,423 @@
+import concurrent.futures
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from email.utils import formatdate
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+from cache_store import CacheStore
+from pipeline import read_build_plan
+
+
+# Packages mmdebstrap selects on top of the layer packages for each variant,
+# as apt patterns. This mirrors mmdebstrap closely enough to warm the cache;
+# mmdebstrap remains authoritative for what is actually installed.
+_ESSENTIAL = "?and(?essential,?architecture(native))"
+_REQUIRED = "?and(?priority(required),?architecture(native))"
+_IMPORTANT = "?and(?priority(important),?architecture(native))"
+_STANDARD = "?and(?priority(standard),?architecture(native))"
+
+VARIANT_PACKAGES = {
+    "extract": [],
+    "custom": [],
+    "essential": [_ESSENTIAL],
+    "apt": [_ESSENTIAL, "apt"],
+    "required": [_ESSENTIAL, _REQUIRED, "apt"],
+    "minbase": [_ESSENTIAL, _REQUIRED, "apt"],
+    "buildd": [_ESSENTIAL, _REQUIRED, "apt", "build-essential"],
+    "important": [_ESSENTIAL, _REQUIRED, _IMPORTANT, "apt"],
+    "debootstrap": [_ESSENTIAL, _REQUIRED, _IMPORTANT, "apt"],
+    "-": [_ESSENTIAL, _REQUIRED, _IMPORTANT, "apt"],
+    "standard": [_ESSENTIAL, _REQUIRED, _IMPORTANT, _STANDARD, "apt"],
+}
+
+_HASHES = {"SHA512": "sha512", "SHA256": "sha256", "SHA1": "sha1", "MD5Sum": "md5"}
+
+# 'URI' filename size HASH:hex, as printed by apt-get --print-uris
+_URI_RE = re.compile(r"^'(?P<uri>[^']+)' (?P<name>\S+) (?P<size>\d+) (?P<hash>\S*)$")
+
+
+def collect_mmdebstrap(plan_path: str) -> Dict[str, Any]:
+    """Merge the mmdebstrap mappings of every layer in a build plan.
+
+    Lists are concatenated in layer order and scalars take the last value
+    set, which is how bdebstrap merges the same chain of --config files.
+    """
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    merged: Dict[str, Any] = {"architectures": [], "mirrors": [], "packages": [],
+                              "aptopts": [], "components": []}
+    for row in read_build_plan(plan_path):
+        if row["mmdebstrap"] != "y":
+            continue
+        with open(row["resolved"], "r", encoding="utf-8") as handle:
+            data = yaml.load(handle, Loader=loader) or {}
+        mm = data.get("mmdebstrap") or {}
+        for key, value in mm.items():
+            if key in merged and isinstance(merged[key], list):
+                items = value if isinstance(value, list) else [value]
+                merged[key].extend(str(v) for v in items if v is not None)
+            elif isinstance(value, (str, int, float)):
+                merged[key] = str(value)
+    return merged
+
+
+def package_args(mm: Dict[str, Any]) -> List[str]:
+    """Package arguments for apt-get install: variant base set plus layer packages.
+
+    Layer package entries may hold several names separated by commas or
+    spaces, as mmdebstrap --include allows. Removals ('name-') are dropped.
+    """
+    args = list(VARIANT_PACKAGES.get(mm.get("variant", "-"), VARIANT_PACKAGES["-"]))
+    for entry in mm["packages"]:
+        for name in re.split(r"[,\s]+", entry):
+            if name and not name.endswith("-") and name not in args:
+                args.append(name)
+    return args
+
+
+def _write_sources(mm: Dict[str, Any], etc: str) -> int:
+    suite = mm.get("suite", "")
+    components = " ".join(mm["components"]) or "main"
+    lines = []
+    count = 0
+    for i, mirror in enumerate(mm["mirrors"]):
+        mirror = os.path.expandvars(mirror.strip())
+        if mirror.endswith((".sources", ".list")) and os.path.isfile(mirror):
+            ext = os.path.splitext(mirror)[1]
+            shutil.copyfile(mirror, os.path.join(etc, "sources.list.d", f"{i:02d}-mirror{ext}"))
+        elif mirror.startswith(("deb ", "deb-src ")):
+            lines.append(mirror)
+        elif "://" in mirror:
+            lines.append(f"deb {mirror} {suite} {components}")
+        else:
+            print(f"Warning: aptcache: ignoring mirror {mirror!r}", file=sys.stderr)
+            continue
+        count += 1
+    with open(os.path.join(etc, "sources.list"), "w", encoding="utf-8") as handle:
+        handle.write("".join(f"{line}\n" for line in lines))
+    return count
+
+
+def make_apt_root(mm: Dict[str, Any], root: str, keydir: Optional[str], proxy: Optional[str]) -> str:
+    """Create a self contained apt state tree under root and return its apt.conf.
+
+    Nothing from the host apt configuration is used. The dpkg status is empty
+    so apt resolves the full closure as for a fresh chroot.
+    """
+    etc = os.path.join(root, "etc", "apt")
+    for d in ("sources.list.d", "apt.conf.d", "preferences.d", "trusted.gpg.d"):
+        os.makedirs(os.path.join(etc, d), exist_ok=True)
+    os.makedirs(os.path.join(root, "var", "lib", "apt", "lists", "partial"), exist_ok=True)
+    os.makedirs(os.path.join(root, "var", "cache", "apt", "archives", "partial"), exist_ok=True)
+    os.makedirs(os.path.join(root, "var", "lib", "dpkg"), exist_ok=True)
+    status = os.path.join(root, "var", "lib", "dpkg", "status")
+    open(status, "w").close()
+
+    if not _write_sources(mm, etc):
+        raise ValueError("no usable mirrors in the layer plan")
+
+    archs = mm["architectures"] or [subprocess.run(
+        ["dpkg", "--print-architecture"], capture_output=True, text=True, check=True).stdout.strip()]
+
+    conf = [
+        f'Dir "{root}/";',
+        f'Dir::State::status "{status}";',
+        f'APT::Architecture "{archs[0]}";',
+        "APT::Architectures { " + " ".join(f'"{a}";' for a in dict.fromkeys(archs)) + " };",
+        'Debug::NoLocking "true";',
+        'Acquire::Languages "none";',
+    ]
+    if keydir:
+        conf.append(f'Dir::Etc::TrustedParts "{keydir}";')
+    if proxy:
+        conf.append(f'Acquire::http::Proxy "{proxy}";')
+    if os.geteuid() == 0:
+        conf.append('APT::Sandbox::User "root";')
+    for opt in mm["aptopts"]:
+        if os.path.isfile(opt):
+            with open(opt, "r", encoding="utf-8") as handle:
+                conf.append(handle.read())
+        else:
+            conf.append(opt if opt.rstrip().endswith(";") else f"{opt};")
+
+    path = os.path.join(root, "apt.conf")
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write("\n".join(conf) + "\n")
+    return path
+
+
+def resolve_uris(apt_conf: str, packages: List[str]) -> List[Dict[str, Any]]:
+    """Update indexes and return the .deb URIs apt would fetch for packages."""
+    env = dict(os.environ, APT_CONFIG=apt_conf, LC_ALL="C")
+    update = subprocess.run(["apt-get", "update", "-qq"], env=env, capture_output=True, text=True)
+    if update.returncode != 0:
+        raise RuntimeError(f"apt-get update failed:\n{update.stderr.strip()}")
+    res = subprocess.run(["apt-get", "install", "--print-uris", "-qq", "--", *packages],
+                         env=env, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"apt-get could not resolve the package set:\n{res.stderr.strip()}")
+    items = []
+    for line in res.stdout.splitlines():
+        m = _URI_RE.match(line)
+        if not m:
+            continue
+        algo, _, digest = m.group("hash").partition(":")
+        items.append({"uri": m.group("uri"), "name": m.group("name"), "size": int(m.group("size")),
+                      "algo": _HASHES.get(algo), "digest": digest.lower()})
+    return items
+
+
+def _fetch(item: Dict[str, Any], cache: str, opener, retries: int = 3) -> int:
+    """Download one .deb into the cache via partial/, verifying size and hash."""
+    dest = os.path.join(cache, item["name"])
+    tmp = os.path.join(cache, "partial", f".{item['name']}.{os.getpid()}.prefetch")
+    uri = item["uri"]
+    if uri.startswith("file:") and not uri.startswith("file://"):
+        uri = "file://" + uri[len("file:"):]
+    error = None
+    for _ in range(retries):
+        digest = hashlib.new(item["algo"]) if item["algo"] else None
+        size = 0
+        try:
+            with opener.open(uri, timeout=60) as src, open(tmp, "wb") as out:
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if digest:
+                        digest.update(chunk)
+                    out.write(chunk)
+            if size != item["size"]:
+                raise ValueError(f"size {size} != {item['size']}")
+            if digest and digest.hexdigest() != item["digest"]:
+                raise ValueError(f"{item['algo']} mismatch")
+            os.replace(tmp, dest)
+            return size
+        except (OSError, ValueError) as exc:
+            error = exc
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    raise RuntimeError(f"{item['name']}: {error}")
+
+
+def prefetch(items: List[Dict[str, Any]], cache: str, jobs: int, proxy: Optional[str]) -> Tuple[int, int, int]:
+    """Fetch items missing from the cache in parallel.
+
+    Returns (cached, fetched, bytes). A cached file with the expected size is
+    taken as present; apt verifies its hash again when it is used.
+    """
+    os.makedirs(os.path.join(cache, "partial"), exist_ok=True)
+    missing = []
+    for item in items:
+        try:
+            if os.stat(os.path.join(cache, item["name"])).st_size == item["size"]:
+                continue
+        except FileNotFoundError:
+            pass
+        missing.append(item)
+
+    handlers = [urllib.request.ProxyHandler({"http": proxy})] if proxy else []
+    opener = urllib.request.build_opener(*handlers)
+
+    total = 0
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(_fetch, item, cache, opener) for item in missing]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                total += future.result()
+            except RuntimeError as exc:
+                failed.append(str(exc))
+    if failed:
+        raise RuntimeError("failed to fetch:\n  " + "\n  ".join(sorted(failed)))
+    return len(items) - len(missing), len(missing), total
+
+
+# The cache doubles as a flat apt repository: Packages and Release at the top
+# level, Filename entries relative to it. Parsed stanzas are kept in the
+# index state file keyed by file name, size and mtime so only new or changed
+# debs are read when the index is refreshed.
+INDEX_DIR = ".index"
+INDEX_VERSION = 1
+REPO_ORIGIN = "rpi-image-gen"
+REPO_LABEL = "rpi-image-gen apt cache"
+
+
+def _deb_stanza(path: str) -> str:
+    """Return the Packages stanza for one .deb, read in a single pass."""
+    fields = subprocess.run(["dpkg-deb", "--field", path], capture_output=True, text=True, check=True).stdout
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    size = 0
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    name = os.path.basename(path)
+    return (fields.rstrip("\n") + f"\nFilename: ./{name}\nSize: {size}"
+            f"\nMD5sum: {md5.hexdigest()}\nSHA256: {sha256.hexdigest()}\n")
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as handle:
+        handle.write(data)
+    os.replace(tmp, path)
+
+
+def update_index(cache: str, jobs: int = 0) -> Tuple[int, int, int]:
+    """Bring Packages/Release in the cache up to date with the debs in it.
+
+    Runs under an exclusive lock so concurrent builds sharing the cache
+    serialise their updates; readers only ever see complete files since each
+    is renamed into place. Returns (total, added, removed).
+    """
+    state_dir = os.path.join(cache, INDEX_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        state_path = os.path.join(state_dir, "state.json")
+        try:
+            with open(state_path, "r", encoding="utf-8") as handle:
+                state = json.load(handle)
+            if state.get("version") != INDEX_VERSION:
+                state = {}
+        except (OSError, ValueError):
+            state = {}
+        known = state.get("debs", {})
+
+        current = {}
+        stale = []
+        with os.scandir(cache) as it:
+            for entry in it:
+                if not entry.name.endswith(".deb") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                prev = known.get(entry.name)
+                if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                    current[entry.name] = prev
+                else:
+                    stale.append((entry.name, st))
+        removed = len(set(known) - set(current) - {name for name, _ in stale})
+
+        if not stale and not removed and os.path.exists(os.path.join(cache, "Release")):
+            return len(current), 0, 0
+
+        def parse(item):
+            name, st = item
+            try:
+                return name, {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                              "stanza": _deb_stanza(os.path.join(cache, name))}
+            except (OSError, subprocess.CalledProcessError):
+                print(f"Warning: aptcache: skipping unreadable {name}", file=sys.stderr)
+                return name, None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+            for name, record in pool.map(parse, stale):
+                if record:
+                    current[name] = record
+
+        packages = "\n".join(current[name]["stanza"] for name in sorted(current)).encode()
+        _write_atomic(os.path.join(cache, "Packages"), packages)
+        _write_atomic(os.path.join(cache, "Packages.gz"), gzip.compress(packages, mtime=0))
+
+        release = [f"Origin: {REPO_ORIGIN}", f"Label: {REPO_LABEL}",
+                   f"Date: {formatdate(usegmt=True)}", "SHA256:"]
+        for fname in ("Packages", "Packages.gz"):
+            with open(os.path.join(cache, fname), "rb") as handle:
+                data = handle.read()
+            release.append(f" {hashlib.sha256(data).hexdigest()} {len(data)} {fname}")
+        _write_atomic(os.path.join(cache, "Release"), ("\n".join(release) + "\n").encode())
+
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as handle:
+            json.dump({"version": INDEX_VERSION, "debs": current}, handle)
+        os.replace(f"{state_path}.tmp", state_path)
+
+        return len(current), len([n for n, _ in stale if n in current]), removed
+
+
+def AptCache_register_parser(subparsers):
+    parser = subparsers.add_parser("aptcache", help="Manage the host side apt package cache")
+    sub = parser.add_subparsers(dest="aptcache_command")
+    sub.required = True
+
+    pre = sub.add_parser("prefetch", help="Download every .deb the layer plan will install into the cache")
+    pre.add_argument("--plan", required=True, help="Build plan written by 'ig pipeline --build-plan-out'")
+    pre.add_argument("--cache", required=True, help="Apt cache directory (IGconf_sys_apt_cachedir)")
+    pre.add_argument("--keydir", help="Trusted keys directory (Dir::Etc::TrustedParts)")
+    pre.add_argument("--proxy", help="HTTP proxy for apt and downloads")
+    pre.add_argument("--jobs", type=int, default=8, help="Parallel downloads (default: 8)")
+    pre.add_argument("--dry-run", action="store_true", help="Resolve and report only")
+    pre.set_defaults(func=_prefetch_main)
+
+    idx = sub.add_parser("index", help="Refresh the Packages/Release index of the cache")
+    idx.add_argument("--cache", required=True, help="Apt cache directory (IGconf_sys_apt_cachedir)")
+    idx.add_argument("--jobs", type=int, default=0, help="Debs parsed at once (default: CPUs)")
+    idx.set_defaults(func=_index_main)
+
+
+def _die(text: str):
+    print(f"Error: aptcache: {text}", file=sys.stderr)
+    raise SystemExit(1)
+
+
+def _prefetch_main(args):
+    if not os.path.isdir(args.cache):
+        _die(f"cache directory {args.cache} does not exist")
+    start = time.monotonic()
+    try:
+        mm = collect_mmdebstrap(args.plan)
+    except (OSError, ValueError, yaml.YAMLError) as exc:
+        _die(str(exc))
+
+    packages = package_args(mm)
+    if not packages:
+        print("aptcache: nothing to prefetch")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="aptcache.") as root:
+        try:
+            conf = make_apt_root(mm, root, args.keydir, args.proxy)
+            items = resolve_uris(conf, packages)
+        except (OSError, ValueError, RuntimeError, subprocess.CalledProcessError) as exc:
+            _die(str(exc))
+
+    if args.dry_run:
+        for item in items:
+            print(item["name"])
+        return
+
+    try:
+        with CacheStore(args.cache).shared():
+            cached, fetched, size = prefetch(items, args.cache, args.jobs, args.proxy)
+    except (OSError, RuntimeError) as exc:
+        _die(str(exc))
+    print(f"aptcache: {len(items)} packages, {cached} cached, {fetched} fetched "
+          f"({size / 1e6:.1f} MB) in {time.monotonic() - start:.1f}s")
+
+
+def _index_main(args):
+    if not os.path.isdir(args.cache):
+        _die(f"cache directory {args.cache} does not exist")
+    start = time.monotonic()
+    try:
+        with CacheStore(args.cache).shared():
+            total, added, removed = update_index(args.cache, args.jobs)
+    except OSError as exc:
+        _die(str(exc))
+    print(f"aptcache: index {total} packages ({added} added, {removed} removed) "
+          f"in {time.monotonic() - start:.1f}s")
@@ -0,0 +1,222 @@
+import contextlib
+import fcntl
+import os
+import re
+import sys
+import time
+from typing import Iterator, List, Tuple
+
+
+# Every shared cache directory (IGconf_sys_cachedir, IGconf_sys_apt_cachedir)
+# carries a .igcache control dir:
+#
+#   .igcache/lock        flock: shared while the cache is in use, exclusive
+#                        while it is being evicted
+#   .igcache/refs/<pid>  one per build holding a reference (informational,
+#                        the lock is what counts)
+#
+# Users - the driver for the length of a build, vfetch, pip via pkg.mk and
+# the apt cache tools - hold the lock shared. New entries are written to a
+# temporary name in the same directory and renamed into place, so readers
+# only ever see complete files. Eviction takes the lock exclusively without
+# waiting, so it only ever runs when nobody holds a reference, and removes
+# the least recently used files until the cache is within its size budget.
+
+CONTROL_DIR = ".igcache"
+
+# Never evicted: control and index state, apt's own lock and partial dir, and
+# the wheels pkg.mk builds, which its build stamps say are still there
+_KEEP_DIRS = {CONTROL_DIR, ".index", "partial", "pip-wheels"}
+_KEEP_FILES = {"lock", "Packages", "Packages.gz", "Release"}
+
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like 512M or 20G (binary units) into bytes."""
+    m = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)(i?B)?\s*", text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"invalid size {text!r}")
+    return int(m.group(1)) * _UNITS[m.group(2).upper()]
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class CacheStore:
+    """A shared cache directory with reference locking and LRU eviction."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.control = os.path.join(self.root, CONTROL_DIR)
+        self.refs_dir = os.path.join(self.control, "refs")
+
+    def _open_lock(self):
+        os.makedirs(self.refs_dir, exist_ok=True)
+        return open(os.path.join(self.control, "lock"), "a")
+
+    @contextlib.contextmanager
+    def shared(self) -> Iterator[None]:
+        """Hold the cache in use for the duration of the block."""
+        with self._open_lock() as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            yield
+
+    @contextlib.contextmanager
+    def exclusive(self, wait: bool = False) -> Iterator[bool]:
+        """Try to hold the cache exclusively. Yields False if it is in use."""
+        with self._open_lock() as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def live_refs(self) -> List[Tuple[int, str]]:
+        """References whose holder is still running, as (pid, description)."""
+        refs = []
+        try:
+            names = os.listdir(self.refs_dir)
+        except FileNotFoundError:
+            return refs
+        for name in names:
+            if not name.isdigit() or not _pid_alive(int(name)):
+                continue
+            try:
+                with open(os.path.join(self.refs_dir, name), "r", encoding="utf-8") as handle:
+                    desc = handle.read().strip()
+            except OSError:
+                continue
+            refs.append((int(name), desc))
+        return sorted(refs)
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """Evictable files as (last use, size, path).
+
+        Last use is the later of atime and mtime, so it works with relatime
+        and noatime mounts alike. Directories that are caches in their own
+        right (they have a control dir) are left to their own budget.
+        """
+        found = []
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs
+                       if d not in _KEEP_DIRS and not os.path.isdir(os.path.join(root, d, CONTROL_DIR))]
+            for name in files:
+                if root == self.root and name in _KEEP_FILES:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+        return found
+
+    def evict(self, budget: int) -> Tuple[int, int]:
+        """Remove least recently used files until the cache fits budget.
+
+        Must be called with the cache held exclusively. Returns
+        (files removed, bytes freed).
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+        dirs = set()
+        for _, size, path in entries:
+            if total - freed <= budget:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+            dirs.add(os.path.dirname(path))
+        # Prune directories emptied below the top level (eg pip cache shards)
+        for d in sorted(dirs, key=len, reverse=True):
+            while os.path.dirname(d) != self.root and d.startswith(self.root + os.sep):
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    break
+                d = os.path.dirname(d)
+        # Nobody holds a reference, so any left behind are stale
+        for name in os.listdir(self.refs_dir):
+            os.unlink(os.path.join(self.refs_dir, name))
+        return removed, freed
+
+
+def _human(size: int) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def CacheStore_register_parser(subparsers):
+    parser = subparsers.add_parser("cache", help="Inspect and trim shared cache directories")
+    sub = parser.add_subparsers(dest="cache_command")
+    sub.required = True
+
+    stat = sub.add_parser("stat", help="Show cache size and live references")
+    stat.add_argument("--root", required=True, help="Cache directory")
+    stat.set_defaults(func=_stat_main)
+
+    evict = sub.add_parser("evict", help="Remove least recently used files down to a size budget")
+    evict.add_argument("--root", required=True, help="Cache directory")
+    evict.add_argument("--max-size", required=True, help="Size budget, eg 20G (0 disables eviction)")
+    evict.add_argument("--wait", action="store_true", help="Wait for other users instead of skipping")
+    evict.set_defaults(func=_evict_main)
+
+
+def _die(text: str):
+    print(f"Error: cache: {text}", file=sys.stderr)
+    raise SystemExit(1)
+
+
+def _stat_main(args):
+    if not os.path.isdir(args.root):
+        _die(f"cache directory {args.root} does not exist")
+    store = CacheStore(args.root)
+    entries = store.entries()
+    print(f"{store.root}: {len(entries)} files, {_human(sum(e[1] for e in entries))}")
+    for pid, desc in store.live_refs():
+        print(f"  ref {pid} {desc}")
+
+
+def _evict_main(args):
+    try:
+        budget = parse_size(args.max_size)
+    except ValueError as exc:
+        _die(str(exc))
+    if budget == 0:
+        return
+    if not os.path.isdir(args.root):
+        _die(f"cache directory {args.root} does not exist")
+
+    store = CacheStore(args.root)
+    start = time.monotonic()
+    with store.exclusive(wait=args.wait) as held:
+        if not held:
+            refs = store.live_refs()
+            print(f"cache: {store.root} in use ({len(refs)} reference(s)), not evicting")
+            return
+        try:
+            removed, freed = store.evict(budget)
+            if removed and os.path.isdir(os.path.join(store.root, ".index")):
+                # Keep an indexed apt cache consistent with what is left
+                from apt_cache import update_index
+                update_index(store.root)
+        except OSError as exc:
+            _die(str(exc))
+    print(f"cache: {store.root}: evicted {removed} file(s), {_human(freed)} "
+          f"in {time.monotonic() - start:.1f}s")
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import sys
@@ -6,9 +7,13 @@ from pathlib import Path
 from typing import Optional, Dict, Any, Tuple
 
 
+_CACHE_VERSION = 2
+
+
 class ConfigLoader:
-    def __init__(self, cfg_path: str, *, expand_vars: bool = True, overrides_path: Optional[str] = None, search_paths: Optional[list[str]] = None):
+    def __init__(self, cfg_path: str, *, expand_vars: bool = True, overrides_path: Optional[str] = None, search_paths: Optional[list[str]] = None, cache_dir: Optional[str] = None):
         self.cfg_path = cfg_path
+        self.cache_dir = cache_dir
         self.overrides_path = overrides_path
         self.expand_vars = expand_vars
         # Support additional include search path
@@ -18,6 +23,9 @@ class ConfigLoader:
         self.data: Dict[str, Dict[str, str]] = {}
         self.trait_overrides: Dict[str, Any] = {}
         self.overrides: Dict[str, str] = {}
+        # section -> key -> [(value, file, line), ...], last entry is the winner
+        self.provenance: Dict[str, Dict[str, list]] = {}
+        self.override_lines: Dict[str, int] = {}
 
         self._load()
         if self.overrides_path:
@@ -71,81 +79,184 @@ class ConfigLoader:
 
     def _load_yaml(self):
         """Load YAML file and convert to internal format"""
-        def _load_yaml_recursive(path: Path, visited: set) -> tuple:
-            if path in visited:
-                raise ValueError(f"Circular include detected in YAML files: {path}")
-            visited.add(path)
-
-            try:
-                with open(path, 'r') as f:
-                    yaml_data = yaml.safe_load(f) or {}
-            except yaml.YAMLError as e:
-                raise ValueError(f"Failed to parse YAML file {path}: {e}")
-
-            if not isinstance(yaml_data, dict):
-                raise ValueError(f"YAML file {path} must contain a mapping at root level")
-
-            # Extract trait section - pass-through, not converted to IGconf_* variables
-            trait_here: Dict[str, Any] = {}
-            if 'trait' in yaml_data:
-                trait_data = yaml_data.pop('trait')
-                if not isinstance(trait_data, dict):
-                    raise ValueError(f"'trait' section in {path} must be a mapping")
-                trait_here = trait_data
-
-            # Handle include directive(s)
-            # Single form: include: file: foo.yaml
-            # List form:   include: [foo.yaml, bar.yaml]  (later entries override earlier)
-            included_sections: Dict[str, Dict[str, str]] = {}
-            included_trait: Dict[str, Any] = {}
-            inc_directive = yaml_data.pop('include', None)
-            if inc_directive is not None:
-                if isinstance(inc_directive, dict):
-                    inc_files = [inc_directive.get('file')]
-                    if not inc_files[0]:
-                        raise ValueError(f"YAML include directive in {path} missing 'file' key")
-                elif isinstance(inc_directive, list):
-                    if not all(isinstance(e, str) for e in inc_directive):
-                        raise ValueError(f"'include' list in {path} must contain filename strings")
-                    inc_files = inc_directive
-                else:
-                    raise ValueError(f"'include' in {path} must be a mapping or list of filenames")
-                for inc_file in inc_files:
-                    inc_path = self._resolve_include(inc_file, path.parent)
-                    inc_sections, inc_trait = _load_yaml_recursive(inc_path, visited)
-                    for sect, mapping in inc_sections.items():
-                        included_sections.setdefault(sect, {}).update(mapping)
-                    included_trait.update(inc_trait)
-
-            # Convert current file sections
-            curr_sections: Dict[str, Dict[str, str]] = {}
-            for sect, sect_data in yaml_data.items():
-                if isinstance(sect_data, list):
-                    curr_sections[sect] = {str(i): str(v) for i, v in enumerate(sect_data)}
-                elif isinstance(sect_data, dict):
-                    curr_sections[sect] = {k: str(v) for k, v in sect_data.items()}
-                else:
-                    raise ValueError(f"Section '{sect}' in {path} must be a mapping or list")
-
-            # Merge: current overrides included
-            merged = {**included_sections}
-            for sect, mapping in curr_sections.items():
-                if sect not in merged:
-                    merged[sect] = {}
-                for k, v in mapping.items():
-                    if sect in included_sections and k in included_sections[sect]:
-                        prev = included_sections[sect][k]
-                        if prev != v:
-                            print(
-                                f"OVR {path}: overrides [{sect}].{k} to '{v}' from '{prev}' (inherited)",
-                                file=sys.stderr,
-                            )
-                    merged[sect][k] = v
-
-            # Merge trait overrides: current file overrides included
-            return merged, {**included_trait, **trait_here}
-
-        self.data, self.trait_overrides = _load_yaml_recursive(Path(self.cfg_path).resolve(), set())
+        root = Path(self.cfg_path).resolve()
+
+        # Each file is read and parsed once per load. A file reached through
+        # more than one include (diamond) is re-applied from the parse cache.
+        self._parsed: Dict[Path, tuple] = {}
+
+        cached = self._cache_lookup(root) if self.cache_dir else None
+        if cached is not None:
+            self.data, self.trait_overrides, self.provenance = cached
+            return
+
+        self._apply_yaml(root, [])
+
+        if self.cache_dir:
+            self._cache_store(root)
+
+    def _parse_yaml_file(self, path: Path) -> tuple:
+        """Read and convert a single YAML file. Returns (sections, lines, trait, includes)."""
+        if path in self._parsed:
+            return self._parsed[path]
+
+        try:
+            with open(path, 'r') as f:
+                loader = yaml.SafeLoader(f)
+                try:
+                    node = loader.get_single_node()
+                    yaml_data = (loader.construct_document(node) if node else None) or {}
+                finally:
+                    loader.dispose()
+        except yaml.YAMLError as e:
+            raise ValueError(f"Failed to parse YAML file {path}: {e}")
+
+        if not isinstance(yaml_data, dict):
+            raise ValueError(f"YAML file {path} must contain a mapping at root level")
+
+        # Extract trait section - pass-through, not converted to IGconf_* variables
+        trait_here: Dict[str, Any] = {}
+        if 'trait' in yaml_data:
+            trait_data = yaml_data.pop('trait')
+            if not isinstance(trait_data, dict):
+                raise ValueError(f"'trait' section in {path} must be a mapping")
+            trait_here = trait_data
+
+        # Handle include directive(s)
+        # Single form: include: file: foo.yaml
+        # List form:   include: [foo.yaml, bar.yaml]  (later entries override earlier)
+        inc_files: list = []
+        inc_directive = yaml_data.pop('include', None)
+        if inc_directive is not None:
+            if isinstance(inc_directive, dict):
+                inc_files = [inc_directive.get('file')]
+                if not inc_files[0]:
+                    raise ValueError(f"YAML include directive in {path} missing 'file' key")
+            elif isinstance(inc_directive, list):
+                if not all(isinstance(e, str) for e in inc_directive):
+                    raise ValueError(f"'include' list in {path} must contain filename strings")
+                inc_files = inc_directive
+            else:
+                raise ValueError(f"'include' in {path} must be a mapping or list of filenames")
+
+        # Convert current file sections
+        curr_sections: Dict[str, Dict[str, str]] = {}
+        for sect, sect_data in yaml_data.items():
+            if isinstance(sect_data, list):
+                curr_sections[sect] = {str(i): str(v) for i, v in enumerate(sect_data)}
+            elif isinstance(sect_data, dict):
+                curr_sections[sect] = {k: str(v) for k, v in sect_data.items()}
+            else:
+                raise ValueError(f"Section '{sect}' in {path} must be a mapping or list")
+
+        self._parsed[path] = (curr_sections, self._key_lines(node), trait_here, inc_files)
+        return self._parsed[path]
+
+    @staticmethod
+    def _key_lines(node) -> Dict[Tuple[str, str], int]:
+        """Map (section, key) to the 1-based line it is defined on."""
+        lines: Dict[Tuple[str, str], int] = {}
+        if not isinstance(node, yaml.MappingNode):
+            return lines
+        for sect_node, body in node.value:
+            sect = str(sect_node.value)
+            if isinstance(body, yaml.MappingNode):
+                for key_node, _ in body.value:
+                    lines[(sect, str(key_node.value))] = key_node.start_mark.line + 1
+            elif isinstance(body, yaml.SequenceNode):
+                for idx, item in enumerate(body.value):
+                    lines[(sect, str(idx))] = item.start_mark.line + 1
+        return lines
+
+    def _apply_yaml(self, path: Path, stack: list):
+        """Apply a file's includes (in order) then the file itself onto self.data.
+
+        Later definitions win. Every change of a key's value is appended to
+        self.provenance so the chain of overrides can be reported later.
+        """
+        if path in stack:
+            raise ValueError(f"Circular include detected in YAML files: {path}")
+
+        curr_sections, lines, trait_here, inc_files = self._parse_yaml_file(path)
+
+        stack.append(path)
+        try:
+            for inc_file in inc_files:
+                self._apply_yaml(self._resolve_include(inc_file, path.parent), stack)
+        finally:
+            stack.pop()
+
+        origin = str(path)
+        for sect, mapping in curr_sections.items():
+            target = self.data.setdefault(sect, {})
+            history = self.provenance.setdefault(sect, {})
+            for k, v in mapping.items():
+                chain = history.setdefault(k, [])
+                entry = (v, origin, lines.get((sect, k), 0))
+                if not chain or chain[-1] != entry:
+                    chain.append(entry)
+                target[k] = v
+
+        self.trait_overrides.update(trait_here)
+
+    # Persistent cache of the merged result. An entry is keyed on the root
+    # config and include search path, and is only reused if every file in the
+    # include closure still has the same content hash and every include name
+    # still resolves to the same file.
+    def _cache_file(self, root: Path) -> Path:
+        key = json.dumps([str(root), [str(p) for p in self.search_paths]])
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return Path(self.cache_dir) / f"config-{digest}.json"
+
+    @staticmethod
+    def _file_digest(path: Path) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _cache_lookup(self, root: Path) -> Optional[tuple]:
+        try:
+            with open(self._cache_file(root), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry.get("version") != _CACHE_VERSION:
+                return None
+            for fname, info in entry["closure"].items():
+                fpath = Path(fname)
+                if self._file_digest(fpath) != info["sha256"]:
+                    return None
+                for inc_name, resolved in info["includes"]:
+                    if str(self._resolve_include(inc_name, fpath.parent)) != resolved:
+                        return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        provenance = {
+            sect: {k: [tuple(e) for e in chain] for k, chain in keys.items()}
+            for sect, keys in entry["provenance"].items()
+        }
+        return entry["data"], entry["trait"], provenance
+
+    def _cache_store(self, root: Path):
+        closure = {}
+        for path, (_, _, _, inc_files) in self._parsed.items():
+            closure[str(path)] = {
+                "sha256": self._file_digest(path),
+                "includes": [[inc, str(self._resolve_include(inc, path.parent))] for inc in inc_files],
+            }
+        entry = {
+            "version": _CACHE_VERSION,
+            "closure": closure,
+            "data": self.data,
+            "trait": self.trait_overrides,
+            "provenance": self.provenance,
+        }
+        target = self._cache_file(root)
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, target)
+        except OSError as e:
+            print(f"Warning: config cache not written ({e})", file=sys.stderr)
 
     def _load_overrides(self):
         """Load override file with key=value pairs and expand variables"""
@@ -186,6 +297,7 @@ class ConfigLoader:
 
                     # Store raw override first
                     self.overrides[key] = value
+                    self.override_lines[key] = line_num
                     # Also add to expansion context for subsequent overrides
                     expansion_context[key] = value
 
@@ -452,6 +564,50 @@ class ConfigLoader:
             else:
                 print(f"CFG {key}={effective_value}")
 
+    def _find_key(self, name: str) -> Optional[Tuple[str, str, str]]:
+        """Resolve an env name or section.key to (env_key, section, key)."""
+        if not name.startswith("IGconf_") and '.' in name:
+            sect, key = name.split('.', 1)
+            if key in self.provenance.get(sect, {}):
+                return (key if sect == "env" else self._env_key(sect, key), sect, key)
+            return None
+        for sect, keys in self.provenance.items():
+            for key in keys:
+                env_key = key if sect == "env" else self._env_key(sect, key)
+                if env_key == name:
+                    return (env_key, sect, key)
+        return None
+
+    def why(self, name: str) -> Optional[list[str]]:
+        """Explain where the effective value of a variable comes from.
+
+        Returns report lines, most significant source first, or None if the
+        variable is not known to the config, overrides or environment.
+        """
+        found = self._find_key(name)
+        env_key = found[0] if found else name
+        chain = self.provenance[found[1]][found[2]] if found else []
+        if not chain and env_key not in self.overrides and env_key not in os.environ:
+            return None
+
+        if env_key in os.environ:
+            effective, source = os.environ[env_key], "env"
+        elif env_key in self.overrides:
+            effective, source = self._expand(self.overrides[env_key]), "override"
+        else:
+            effective, source = self._expand(chain[-1][0]), "config"
+
+        report = [f"{env_key}={effective} ({source})"]
+        if env_key in os.environ:
+            report.append("  [env] set in the calling environment")
+        if env_key in self.overrides:
+            label = "override" if source == "override" else "shadowed"
+            report.append(f"  [{label}] {self.overrides_path}:{self.override_lines.get(env_key, 0)}: '{self.overrides[env_key]}'")
+        for idx, (value, origin, line) in enumerate(reversed(chain)):
+            label = "config" if idx == 0 and source == "config" else "shadowed"
+            report.append(f"  [{label}] {origin}:{line}: '{value}'")
+        return report
+
 
 def ConfigLoader_register_parser(subparsers):
     parser = subparsers.add_parser("config", help="Config utilities (.yaml)")
@@ -461,6 +617,8 @@ def ConfigLoader_register_parser(subparsers):
     parser.add_argument("--no-expand", action="store_true", help="Disable $VAR expansion")
     parser.add_argument("--write-to", metavar="FILE", help="Write variables to file instead of env load")
     parser.add_argument("--overrides", metavar="FILE", help="Override file with key=value pairs")
+    parser.add_argument("--why", metavar="KEY", help="Show where KEY (IGconf_* name or section.key) is set and what it overrides")
+    parser.add_argument("--cache-dir", metavar="DIR", help="Cache the merged include tree here, reused while no included file changes")
     parser.add_argument("-S", "--srcroot", dest="srcroot", metavar="DIR", help="Custom source tree (adds its trait/ to --trait search)")
     parser.add_argument("--gen", action="store_true", help="Generate example .yaml with include syntax")
     parser.add_argument("--trait", metavar="TOKEN", nargs="?", const="", help="Expand a trait token and show its full token set; omit TOKEN to list all")
@@ -487,8 +645,15 @@ def _main(args):
             expand_vars=not args.no_expand,
             overrides_path=args.overrides,
             search_paths=(args.path.split(":") if args.path else ["./config"]),
+            cache_dir=args.cache_dir,
         )
-        if args.write_to:
+        if args.why:
+            report = loader.why(args.why)
+            if report is None:
+                print(f"{args.why} is not set by {loader.cfg_path}", file=sys.stderr)
+                raise SystemExit(1)
+            print("\n".join(report))
+        elif args.write_to:
             loader.write_file(args.write_to, args.section)
         else:
             if args.section:
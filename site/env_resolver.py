@@ -3,9 +3,13 @@ from __future__ import annotations
 import json
 import os
 import re
-from collections import OrderedDict
+import subprocess
+import sys
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from itertools import groupby
 from pathlib import Path
-from typing import Dict, Mapping, Optional, Any
+from typing import Dict, Mapping, Optional, Any, Tuple
 
 __all__ = [
     "AssignmentError",
@@ -14,6 +18,7 @@ __all__ = [
     "load_env_file",
     "write_env_file",
     "LazyEnvResolver",
+    "posix_expand",
     "AnchorRegistry",
     "write_anchor_manifest",
     "resolve_env_file",
@@ -22,6 +27,16 @@ __all__ = [
 
 _VAR_PATTERN = re.compile(r"\$\{([^}]+)\}")
 _VALID_VAR = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_POSIX_PARAM = re.compile(r"^(#)?([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-=?+]|##?|%%?)(.*))?$", re.S)
+_BARE_DOLLAR = re.compile(r"\$(?![({])")
+
+
+@lru_cache(maxsize=None)
+def _normalize_anchor(name: str) -> str:
+    name = name.strip()
+    if not name.startswith("@"):
+        name = f"@{name}"
+    return name.upper()
 
 
 class AssignmentError(Exception):
@@ -62,20 +77,230 @@ def write_env_file(
     path: str | os.PathLike[str],
     assignments: Mapping[str, str],
     resolved_values: Mapping[str, str],
+    *,
+    quoted: bool = False,
 ) -> None:
     """Write resolved values back to disk using simple key=value syntax."""
     target = Path(path)
     target.parent.mkdir(parents=True, exist_ok=True)
+    fmt = '{}="{}"\n' if quoted else "{}={}\n"
     with open(target, "w", encoding="utf-8") as handle:
         for name in assignments:
-            handle.write(f"{name}={resolved_values.get(name, '')}\n")
+            handle.write(fmt.format(name, resolved_values.get(name, "")))
+
+
+def _shell_escape(value: str) -> str:
+    """Escape a value for a double-quoted sh word, leaving ${...} and $(...) live."""
+    value = value.replace("\\", "\\\\").replace('"', '\\"').replace("`", "\\`")
+    return _BARE_DOLLAR.sub(r"\\$", value)
+
+
+def _match_paren(text: str, start: int) -> int:
+    """Return the index of the ')' closing the '(' at text[start]."""
+    depth = 0
+    i = start
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "'":
+            end = text.find("'", i + 1)
+            if end < 0:
+                break
+            i = end + 1
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise AssignmentError("Unterminated command substitution")
+
+
+def _match_brace(text: str, start: int) -> int:
+    """Return the index of the '}' closing the '${' at text[start]."""
+    depth = 0
+    i = start
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "$" and text.startswith("$(", i):
+            i = _match_paren(text, i + 1) + 1
+            continue
+        if c == "$" and text.startswith("${", i):
+            depth += 1
+            i += 2
+            continue
+        if c == "}":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise AssignmentError("Unterminated parameter expansion")
+
+
+def _posix_command(token: str, scope: Mapping[str, str]) -> str:
+    """Run a $(...) or $((...)) token under /bin/sh and return its expansion."""
+    env = {"POSIXLY_CORRECT": "1", **scope}
+    script = f'set -eu\n_ig_v="{token}"\nprintf "%s" "$_ig_v"'
+    try:
+        res = subprocess.run(["/bin/sh", "-c", script], env=env,
+                             stdout=subprocess.PIPE, text=True, check=False)
+    except OSError as exc:
+        raise AssignmentError(f"Command substitution {token} failed: {exc}")
+    if res.returncode != 0:
+        raise AssignmentError(f"Command substitution {token} exited {res.returncode}")
+    return res.stdout
+
+
+def _glob_regex(pattern: str) -> str:
+    out: list[str] = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            out.append(".*")
+        elif c == "?":
+            out.append(".")
+        elif c == "[":
+            j = i + 1 if pattern[i:i + 1] == "!" else i
+            j = pattern.find("]", j + 1 if pattern[j:j + 1] == "]" else j)
+            if j < 0:
+                out.append("\\[")
+                continue
+            body = pattern[i:j].replace("\\", "\\\\")
+            out.append("[^" + body[1:] + "]" if body.startswith("!") else "[" + body + "]")
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out)
+
+
+def _posix_trim(value: str, op: str, word: str, scope: Mapping[str, str]) -> str:
+    # Escaped characters in the pattern are literal, the rest is a glob
+    regex = re.compile("".join(
+        re.escape(text) if quoted else _glob_regex(text)
+        for quoted, text in ((q, "".join(t for t, _ in run))
+                             for q, run in groupby(_posix_scan(word, scope), key=lambda p: p[1]))
+    ), re.S)
+    n = len(value)
+    if op in ("#", "##"):
+        cuts = range(n + 1) if op == "#" else range(n, -1, -1)
+        for i in cuts:
+            if regex.fullmatch(value[:i]):
+                return value[i:]
+    else:
+        cuts = range(n, -1, -1) if op == "%" else range(n + 1)
+        for i in cuts:
+            if regex.fullmatch(value[i:]):
+                return value[:i]
+    return value
+
+
+def _posix_param(expr: str, scope: Dict[str, str]) -> str:
+    match = _POSIX_PARAM.match(expr)
+    if not match or (match.group(1) and match.group(3)):
+        raise AssignmentError(f"Unsupported parameter expansion '${{{expr}}}'")
+    length, name, op, word = match.groups()
+    value = scope.get(name)
+    if op in ("-", ":-", "=", ":=", "?", ":?", "+", ":+"):
+        unset = value is None or (op[0] == ":" and not value)
+        if op[-1] == "+":
+            return _posix_expand_value(word, scope) if not unset else ""
+        if not unset:
+            return value
+        if op[-1] == "-":
+            return _posix_expand_value(word, scope)
+        if op[-1] == "=":
+            value = scope[name] = _posix_expand_value(word, scope)
+            return value
+        raise AssignmentError(f"{name}: {_posix_expand_value(word, scope) or 'parameter null or not set'}")
+    if value is None:
+        raise UndefinedVariableError(f"{name}: parameter not set")
+    if length:
+        return str(len(value))
+    if op:
+        return _posix_trim(value, op, word, scope)
+    return value
+
+
+def _posix_scan(text: str, scope: Dict[str, str]) -> list[tuple[str, bool]]:
+    """Expand the body of a double-quoted sh word into (text, quoted) pieces.
+
+    Backslash escaped characters come back as quoted pieces so pattern
+    operators can tell them apart from glob characters.
+    """
+    pieces: list[tuple[str, bool]] = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\" and i + 1 < n and text[i + 1] in '$`"\\\n':
+            if text[i + 1] != "\n":
+                pieces.append((text[i + 1], True))
+            i += 2
+        elif c == "$" and text.startswith("${", i):
+            end = _match_brace(text, i)
+            pieces.append((_posix_param(text[i + 2:end], scope), False))
+            i = end + 1
+        elif c == "$" and text.startswith("$(", i):
+            end = _match_paren(text, i + 1)
+            pieces.append((_posix_command(text[i:end + 1], scope), False))
+            i = end + 1
+        else:
+            pieces.append((c, False))
+            i += 1
+    return pieces
+
+
+def _posix_expand_value(text: str, scope: Dict[str, str]) -> str:
+    if "$" not in text and "\\" not in text:
+        return text
+    return "".join(piece for piece, _ in _posix_scan(text, scope))
+
+
+def posix_expand(assignments: Mapping[str, str]) -> "OrderedDict[str, str]":
+    """Expand values in order with strict POSIX shell semantics.
+
+    Equivalent to sourcing each assignment as KEY="value" under 'set -aeu'
+    and printing it back. Backslashes, double quotes, backticks and any '$'
+    not introducing ${...} or $(...) are escaped first, so they stay literal
+    everywhere, including inside $(...) where eg $(echo $A) prints '$A'.
+    ${VAR} refers only to earlier assignments and fails if unset. The POSIX
+    parameter forms -, =, ?, + (each with or without ':'), ${#VAR} and the
+    #, ##, %, %% pattern removals are supported; anything else raises
+    AssignmentError. $(cmd) and $((expr)) run under /bin/sh with earlier
+    assignments exported.
+    """
+    scope: Dict[str, str] = {}
+    for name, value in assignments.items():
+        try:
+            scope[name] = _posix_expand_value(_shell_escape(value), scope)
+        except AssignmentError as exc:
+            raise type(exc)(f"{name}: {exc}") from None
+    return OrderedDict((name, scope[name]) for name in assignments)
 
 
 class AnchorRegistry:
-    """Tracks anchor metadata and resolved values."""
+    """Tracks anchor metadata and resolved values.
+
+    Bindings (anchor -> variable) are held in a flat index keyed by the
+    normalised anchor name so lookups during expansion are a single dict hit.
+    Usage is kept as a per-anchor Counter of referencing variables.
+    """
 
     def __init__(self, initial: Optional[Mapping[str, Any]] = None):
         self._anchors: Dict[str, Dict[str, Any]] = {}
+        self._usage: Dict[str, Counter] = {}
         if initial:
             for name, entry in initial.items():
                 norm = self.normalize(name)
@@ -85,63 +310,77 @@ class AnchorRegistry:
                 else:
                     var_name = None
                     value = entry
-                self._anchors[norm] = {"var": var_name, "value": value, "referenced_by": set()}
+                self._anchors[norm] = {"var": var_name, "value": value}
 
     @staticmethod
     def normalize(name: str) -> str:
         if not name:
             raise AssignmentError("Anchor name cannot be empty")
-        name = name.strip()
-        if not name.startswith("@"):
-            name = f"@{name}"
-        return name.upper()
+        return _normalize_anchor(name)
+
+    def _entry(self, norm: str) -> Dict[str, Any]:
+        entry = self._anchors.get(norm)
+        if entry is None:
+            entry = self._anchors[norm] = {"var": None, "value": None}
+        return entry
 
     def register(self, anchor_name: str, *, var_name: Optional[str] = None) -> None:
-        norm = self.normalize(anchor_name)
-        entry = self._anchors.setdefault(norm, {"var": None, "value": None, "referenced_by": set()})
+        entry = self._entry(self.normalize(anchor_name))
         if var_name:
             if entry["var"] and entry["var"] != var_name:
-                raise AssignmentError(f"Anchor {norm} already bound to {entry['var']}")
+                raise AssignmentError(f"Anchor {self.normalize(anchor_name)} already bound to {entry['var']}")
             entry["var"] = var_name
 
     def get_var(self, anchor_name: str) -> Optional[str]:
-        norm = self.normalize(anchor_name)
-        entry = self._anchors.get(norm)
+        entry = self._anchors.get(self.normalize(anchor_name))
         if entry:
             return entry.get("var")
         return None
 
     def mark_usage(self, anchor_name: str, owner: str) -> None:
         norm = self.normalize(anchor_name)
-        entry = self._anchors.setdefault(norm, {"var": None, "value": None, "referenced_by": set()})
-        entry["referenced_by"].add(owner)
+        counts = self._usage.get(norm)
+        if counts is None:
+            self._entry(norm)
+            counts = self._usage[norm] = Counter()
+        counts[owner] += 1
+
+    def usage(self, anchor_name: str) -> Dict[str, int]:
+        """Return {referencing variable: reference count} for an anchor."""
+        return dict(self._usage.get(self.normalize(anchor_name), {}))
 
     def set_value(self, anchor_name: str, value: str) -> None:
-        norm = self.normalize(anchor_name)
-        entry = self._anchors.setdefault(norm, {"var": None, "value": None, "referenced_by": set()})
-        entry["value"] = value
+        self._entry(self.normalize(anchor_name))["value"] = value
 
     def capture_values(self, env_values: Mapping[str, str]) -> None:
-        for norm, entry in self._anchors.items():
+        for entry in self._anchors.values():
             target = entry.get("var")
             if target and target in env_values:
                 entry["value"] = env_values[target]
 
+    def lookup(self, anchor_name: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return (value, bound variable) for an anchor in one lookup."""
+        entry = self._anchors.get(self.normalize(anchor_name))
+        if not entry:
+            return None, None
+        return entry.get("value"), entry.get("var")
+
     def resolve(self, anchor_name: str) -> str:
-        norm = self.normalize(anchor_name)
-        entry = self._anchors.get(norm)
-        if not entry or entry.get("value") is None:
-            raise AssignmentError(f"Anchor {norm} has no assigned value")
-        return entry["value"]
+        value, _ = self.lookup(anchor_name)
+        if value is None:
+            raise AssignmentError(f"Anchor {self.normalize(anchor_name)} has no assigned value")
+        return value
 
     def to_payload(self) -> Dict[str, Any]:
         payload: Dict[str, Any] = {}
-        for name, entry in self._anchors.items():
+        for name in sorted(self._anchors):
+            entry = self._anchors[name]
             payload[name] = {
                 "var": entry.get("var"),
                 "value": entry.get("value"),
+                "references": dict(sorted(self._usage.get(name, {}).items())),
             }
-        return dict(sorted(payload.items()))
+        return payload
 
 
 def write_anchor_manifest(
@@ -218,13 +457,12 @@ class LazyEnvResolver:
                 self.anchor_registry.mark_usage(token, current_var)
                 if self.preserve_anchors:
                     return match.group(0)
-                try:
-                    return self.anchor_registry.resolve(token)
-                except AssignmentError:
-                    bound_var = self.anchor_registry.get_var(token)
-                    if bound_var:
-                        return self.resolve(bound_var)
-                    raise
+                value, bound_var = self.anchor_registry.lookup(token)
+                if value is not None:
+                    return value
+                if bound_var:
+                    return self.resolve(bound_var)
+                return self.anchor_registry.resolve(token)
             if not _VALID_VAR.match(token):
                 raise AssignmentError(f"Invalid reference '${{{token}}}' in {current_var}")
             return self.resolve(token)
@@ -289,4 +527,3 @@ def _resolve_main(args):
     except AssignmentError as exc:
         print(f"Error: {exc}")
         raise SystemExit(1)
-
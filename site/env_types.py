@@ -1043,6 +1043,7 @@ class MetadataContainer:
         self.required_vars: List[str] = []
         self.optional_vars: List[str] = []
         self.raw_metadata: Dict[str, str] = {}
+        self.anchors: Dict[str, str] = {}  # normalised @ANCHOR -> variable name
 
     @classmethod
     def from_metadata_dict(cls, metadata_dict: Dict[str, str],
@@ -1072,6 +1073,8 @@ class MetadataContainer:
                         source_layer="", position=0
                     )
                     container.variables[env_var.name] = env_var
+                    if env_var.anchor_name:
+                        container.anchors.setdefault(env_var.anchor_name.upper(), env_var.name)
                 except ValueError as e:
                     # Re-raise to fail layer loading
                     raise ValueError(f"Invalid specifier for variable {var_name}: {e}")
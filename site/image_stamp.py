@@ -0,0 +1,284 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import stat
+import sys
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+# Image stage fingerprinting. The image outputdir carries a .imagestamp
+# control dir:
+#
+#   .imagestamp/stamp.json    fingerprint of the inputs of the last good image
+#                             run and the artefacts it produced
+#   .imagestamp/pending.json  fingerprint of the run in progress and a
+#                             snapshot of the outputdir taken before it
+#   .imagestamp/files.json    rootfs digest cache
+#
+# 'check' runs after the pre-image hooks, so the generated genimage configs
+# and any rootfs changes they make are covered. If the fingerprint matches
+# the stamp and every artefact is still in place, genimage and the
+# post-image hooks are skipped. 'record' runs after the post-image hooks
+# and stamps whatever the run added or changed in the outputdir.
+#
+# The pre-image and post-image hooks and the tools they run are passed in
+# with --input, so a change to any of them regenerates the image too.
+#
+# The rootfs is compared by content, ownership, mode and xattrs, not by
+# mtime, so an identical rebuild of the filesystem still matches. Digests
+# are cached by inode, size, mtime and ctime so an untouched rootfs (eg
+# 'build -I') is not read again.
+
+STAMP_DIR = ".imagestamp"
+STAMP_VERSION = 2
+
+# Variables that go into the fingerprint. The hooks may read any IGconf
+# variable, so everything is in bar host settings, the stages that come after
+# the image and those that cannot change the result.
+VAR_PREFIX = "IGconf_"
+VAR_IGNORE_PREFIXES = ("IGconf_sys_", "IGconf_deploy_")
+VAR_IGNORE = {"IGconf_image_genimage_jobs", "IGconf_image_reuse"}
+
+_PATH_RE = re.compile(r"(/[^\s'\"]+)")
+_CHUNK = 1 << 20
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _xattrs(path: str) -> str:
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return ""
+    attrs = []
+    for name in sorted(names):
+        try:
+            attrs.append(f"{name}={os.getxattr(path, name, follow_symlinks=False).hex()}")
+        except OSError:
+            continue
+    return ",".join(attrs)
+
+
+def rootfs_digest(rootfs: str, cache: Dict[str, list], jobs: int = 0) -> Tuple[str, Dict[str, list], int]:
+    """Digest a filesystem tree by content and metadata.
+
+    cache maps relative paths to [ino, size, mtime_ns, ctime_ns, sha256]
+    from a previous run. Returns (digest, new cache, files read).
+    """
+    entries = []
+    todo = []
+    new_cache: Dict[str, list] = {}
+    for root, dirs, files in os.walk(rootfs):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, rootfs)
+            st = os.lstat(path)
+            meta = f"{rel}\0{st.st_mode:o}\0{st.st_uid}\0{st.st_gid}\0{_xattrs(path)}"
+            if stat.S_ISREG(st.st_mode):
+                key = [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+                old = cache.get(rel)
+                if old and old[:4] == key:
+                    new_cache[rel] = old
+                else:
+                    new_cache[rel] = key + [None]
+                    todo.append(rel)
+                entries.append((meta, rel))
+            elif stat.S_ISLNK(st.st_mode):
+                entries.append((f"{meta}\0{os.readlink(path)}", None))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                entries.append((f"{meta}\0{st.st_rdev}", None))
+            else:
+                entries.append((meta, None))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        for rel, digest in zip(todo, pool.map(lambda r: _file_digest(os.path.join(rootfs, r)), todo)):
+            new_cache[rel][4] = digest
+
+    h = hashlib.sha256()
+    for meta, rel in entries:
+        h.update(meta.encode(errors="surrogateescape"))
+        if rel is not None:
+            h.update(b"\0" + new_cache[rel][4].encode())
+        h.update(b"\n")
+    return h.hexdigest(), new_cache, len(todo)
+
+
+def snapshot(outdir: str) -> Dict[str, list]:
+    """Files in the outputdir as relative path -> [size, mtime_ns]."""
+    found = {}
+    for root, dirs, files in os.walk(outdir):
+        dirs[:] = [d for d in dirs if not (root == outdir and d == STAMP_DIR)]
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            found[os.path.relpath(path, outdir)] = [st.st_size, st.st_mtime_ns]
+    return found
+
+
+def fingerprint(rootfs: str, outdir: str, env: Dict[str, str], cache: Dict[str, list],
+                jobs: int = 0, inputs: Iterable[str] = ()) -> Tuple[Dict[str, Any], Dict[str, list], int]:
+    """Fingerprint the image inputs. Returns (components, rootfs cache, files read).
+
+    inputs are further files the image stage runs or reads, eg its hooks.
+    """
+    configs = {}
+    refs = {}
+    for name in sorted(os.listdir(outdir)):
+        path = os.path.join(outdir, name)
+        if not (name.startswith("genimage") and name.endswith(".cfg") and os.path.isfile(path)):
+            continue
+        configs[name] = _file_digest(path)
+        # Scripts and config files the genimage config hands to its tools
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for ref in _PATH_RE.findall(f.read()):
+                ref = os.path.normpath(ref)
+                if ref in refs or ref.startswith((outdir + os.sep, rootfs + os.sep)):
+                    continue
+                if os.path.isfile(ref):
+                    refs[ref] = _file_digest(ref)
+
+    hooks = {}
+    for path in inputs:
+        path = os.path.abspath(path)
+        if path not in hooks and os.path.isfile(path):
+            hooks[path] = _file_digest(path)
+
+    variables = {k: v for k, v in env.items()
+                 if k.startswith(VAR_PREFIX) and not k.startswith(VAR_IGNORE_PREFIXES) and k not in VAR_IGNORE}
+    digest, cache, read = rootfs_digest(rootfs, cache, jobs)
+    components = {
+        "variables": dict(sorted(variables.items())),
+        "configs": configs,
+        "references": dict(sorted(refs.items())),
+        "inputs": dict(sorted(hooks.items())),
+        "rootfs": digest,
+    }
+    return components, cache, read
+
+
+def changed(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[str]:
+    """Describe the first difference between two fingerprints, None if equal."""
+    if old.get("rootfs") != new["rootfs"]:
+        return "rootfs changed"
+    for part in ("configs", "references", "inputs", "variables"):
+        before, after = old.get(part, {}), new[part]
+        for key in sorted(set(before) | set(after)):
+            if before.get(key) != after.get(key):
+                return f"{key} changed"
+    return None
+
+
+def _load(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != STAMP_VERSION:
+        return None
+    return data
+
+
+def _save(path: str, data: Dict[str, Any]) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def ImageStamp_register_parser(subparsers):
+    parser = subparsers.add_parser("imagestamp", help="Fingerprint image inputs to skip unchanged regeneration")
+    sub = parser.add_subparsers(dest="imagestamp_command")
+    sub.required = True
+
+    check = sub.add_parser("check", help="Exit 0 if the previous image artefacts can be reused")
+    check.add_argument("--rootfs", required=True, help="Filesystem the image is made from (IGconf_target_path)")
+    check.add_argument("--outdir", required=True, help="Image output directory (IGconf_image_outputdir)")
+    check.add_argument("--force", action="store_true", help="Fingerprint only, always regenerate")
+    check.add_argument("--jobs", type=int, default=0, help="Files hashed at once (default: CPUs)")
+    check.add_argument("--input", action="append", default=[], metavar="FILE",
+                       help="Hook or tool the image stage runs (repeatable)")
+    check.set_defaults(func=_check_main)
+
+    record = sub.add_parser("record", help="Stamp the artefacts of a completed image run")
+    record.add_argument("--outdir", required=True, help="Image output directory (IGconf_image_outputdir)")
+    record.set_defaults(func=_record_main)
+
+
+def _die(text: str):
+    print(f"Error: imagestamp: {text}", file=sys.stderr)
+    raise SystemExit(2)
+
+
+def _check_main(args):
+    rootfs, outdir = os.path.abspath(args.rootfs), os.path.abspath(args.outdir)
+    for d in (rootfs, outdir):
+        if not os.path.isdir(d):
+            _die(f"{d} is not a directory")
+    control = os.path.join(outdir, STAMP_DIR)
+    stamp_path = os.path.join(control, "stamp.json")
+    cache_path = os.path.join(control, "files.json")
+
+    start = time.monotonic()
+    cache = _load(cache_path) or {}
+    try:
+        os.makedirs(control, exist_ok=True)
+        components, files, read = fingerprint(rootfs, outdir, dict(os.environ), cache.get("files", {}),
+                                             args.jobs, args.input)
+        _save(cache_path, {"version": STAMP_VERSION, "files": files})
+        _save(os.path.join(control, "pending.json"),
+              {"version": STAMP_VERSION, "fingerprint": components, "snapshot": snapshot(outdir)})
+    except OSError as exc:
+        _die(str(exc))
+    secs = time.monotonic() - start
+
+    stamp = _load(stamp_path)
+    reason = "regeneration forced" if args.force else None
+    if reason is None:
+        reason = "no previous image" if stamp is None else changed(stamp["fingerprint"], components)
+    if reason is None:
+        now = snapshot(outdir)
+        for name, meta in sorted(stamp.get("artefacts", {}).items()):
+            if now.get(name) != meta:
+                reason = f"{name} missing or modified"
+                break
+    if reason is not None:
+        # Whatever happens next, the old artefacts no longer match
+        if os.path.exists(stamp_path):
+            os.unlink(stamp_path)
+        print(f"imagestamp: {reason}, regenerating ({read} files hashed in {secs:.1f}s)")
+        raise SystemExit(1)
+    print(f"imagestamp: inputs unchanged, reusing {len(stamp['artefacts'])} artefact(s) "
+          f"({read} files hashed in {secs:.1f}s)")
+
+
+def _record_main(args):
+    outdir = os.path.abspath(args.outdir)
+    control = os.path.join(outdir, STAMP_DIR)
+    pending_path = os.path.join(control, "pending.json")
+    pending = _load(pending_path)
+    if pending is None:
+        _die(f"no pending fingerprint in {control}, run 'check' first")
+
+    before = pending["snapshot"]
+    artefacts = {name: meta for name, meta in snapshot(outdir).items() if before.get(name) != meta}
+    try:
+        _save(os.path.join(control, "stamp.json"),
+              {"version": STAMP_VERSION, "fingerprint": pending["fingerprint"], "artefacts": artefacts})
+        os.unlink(pending_path)
+    except OSError as exc:
+        _die(str(exc))
+    print(f"imagestamp: recorded {len(artefacts)} artefact(s)")
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
 import os
 from collections import OrderedDict
 from typing import List, Optional, Dict, Tuple
 
+import yaml
+
 from layer_manager import LayerManager
 from env_types import EnvVariable, VariableResolver, XEnv
 from env_resolver import (
@@ -13,6 +16,8 @@ from env_resolver import (
     write_env_file,
     LazyEnvResolver,
     AnchorRegistry,
+    AssignmentError,
+    posix_expand,
 )
 from logger import LogConfig, log_error, log_info
 from validators import parse_validator
@@ -34,6 +39,8 @@ def Pipeline_register_parser(subparsers, root=None):
     parser.add_argument("--path", "-p", default=default_paths, help=help_text)
     parser.add_argument("--env-out", required=True, help="Write fully resolved env (anchors expanded)")
     parser.add_argument("--plan-out", help="Write layer build plan to this file")
+    parser.add_argument("--build-plan-out", help="Write the enriched, tab separated build plan to this file")
+    parser.add_argument("--final-out", help="Write the POSIX shell expanded env (KEY=\"value\") to this file")
     parser.set_defaults(func=_pipeline_main)
 
 
@@ -136,6 +143,8 @@ def _pipeline_main(args):
 
     if args.plan_out:
         _write_layer_plan(args.plan_out, build_order, manager)
+    if args.build_plan_out:
+        _write_build_plan(args.build_plan_out, build_order, manager)
 
     layer_anchor_map = _build_anchor_map_from_layers(manager, build_order)
     source_anchors = layer_anchor_map or {}
@@ -148,7 +157,6 @@ def _pipeline_main(args):
 
     # Resolve now
     from env_resolver import (
-            AssignmentError,
             CircularReferenceError,
             UndefinedVariableError,
             )
@@ -171,6 +179,14 @@ def _pipeline_main(args):
     # Write out
     write_env_file(args.env_out, assignments, final_values)
 
+    if args.final_out:
+        ordered = OrderedDict((name, final_values.get(name, "")) for name in assignments)
+        try:
+            expanded = posix_expand(ordered)
+        except AssignmentError as e:
+            raise SystemExit(f"Layer env expansion failed: {e}")
+        write_env_file(args.final_out, expanded, expanded, quoted=True)
+
 
 def _inject_root_anchors(anchor_map: Dict[str, Dict[str, Optional[str]]], env_assignments: Dict[str, str]) -> None:
     for root_var in ("IGROOT", "SRCROOT"):
@@ -209,15 +225,76 @@ def _write_layer_plan(path: str, build_order: List[str], manager: LayerManager)
         raise SystemExit(1)
 
 
+BUILD_PLAN_COLUMNS = ("layer", "version", "static", "resolved", "mmdebstrap", "overlay", "sha256")
+
+
+def _write_build_plan(path: str, build_order: List[str], manager: LayerManager) -> None:
+    """Write the build plan with everything the driver needs per layer.
+
+    One tab separated row per layer in build order: the layer.plan fields,
+    whether the resolved YAML has an mmdebstrap mapping (y/n), the layer's
+    rootfs overlay dir if present, and the sha256 of the resolved file.
+    Empty fields are written as '-' so the row splits cleanly on tabs.
+    """
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    rows = []
+    for layer in build_order:
+        key = manager._resolve_key(layer)
+        info = manager.get_layer_info(layer) or {}
+        static = manager.layer_source_files.get(key, "")
+        resolved = manager.layer_files.get(key, "")
+        try:
+            with open(resolved, "rb") as handle:
+                raw = handle.read()
+            data = yaml.load(raw, Loader=loader)
+        except (OSError, yaml.YAMLError) as exc:
+            log_error(f"Error: layer {layer} ({resolved}): {exc}")
+            raise SystemExit(1)
+        mmdebstrap = "y" if isinstance(data, dict) and data.get("mmdebstrap") else "n"
+        stem = static[:-len(".yaml")] if static.endswith(".yaml") else static
+        overlay = f"{stem}.rootfs-overlay" if static and os.path.isdir(f"{stem}.rootfs-overlay") else ""
+        rows.append((layer, info.get("version", ""), static, resolved, mmdebstrap, overlay,
+                     hashlib.sha256(raw).hexdigest()))
+
+    try:
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write("# " + "\t".join(BUILD_PLAN_COLUMNS) + "\n")
+            for row in rows:
+                handle.write("\t".join(field or "-" for field in row) + "\n")
+        print(f"Build plan written to: {path}")
+    except OSError as exc:
+        print(f"Error writing build plan to {path}: {exc}")
+        raise SystemExit(1)
+
+
+def read_build_plan(path: str) -> List[Dict[str, str]]:
+    """Read a build plan written by _write_build_plan into a list of row dicts.
+
+    '-' placeholders are returned as empty strings.
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != len(BUILD_PLAN_COLUMNS):
+                raise ValueError(f"{path}: malformed build plan row: {line!r}")
+            rows.append({k: ("" if v == "-" else v) for k, v in zip(BUILD_PLAN_COLUMNS, fields)})
+    return rows
+
+
 def _build_anchor_map_from_layers(manager: LayerManager, layers: List[str]) -> Dict[str, Dict[str, Optional[str]]]:
+    # Bindings are indexed per layer at load time (MetadataContainer.anchors),
+    # so this is a merge of small dicts rather than a walk of every variable.
     anchor_bindings: Dict[str, str] = {}
     for layer in layers:
         meta = manager.layers.get(manager._resolve_key(layer))
         if not meta:
             continue
-        for env_var in meta._container.variables.values():
-            if getattr(env_var, "anchor_name", None):
-                anchor_bindings.setdefault(env_var.anchor_name, env_var.name)
+        for anchor, var_name in meta._container.anchors.items():
+            anchor_bindings.setdefault(anchor, var_name)
     return {anchor: {"var": var_name} for anchor, var_name in anchor_bindings.items()}
 
 
@@ -0,0 +1,143 @@
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+
+# Records are appended by the shell span helper (lib/common.sh) as tab
+# separated lines: name, category, start_us, end_us, pid, rc, then zero or
+# more key=value fields carried through as span args.
+
+def read_trace_log(path: str) -> List[Dict[str, Any]]:
+    """Parse a span log into a list of span dicts ordered by start time."""
+    spans: List[Dict[str, Any]] = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) < 6:
+                raise ValueError(f"{path}:{line_num}: expected at least 6 fields, got {len(fields)}")
+            name, category, start, end, pid, rc = fields[:6]
+            try:
+                span = {
+                    "name": name,
+                    "category": category,
+                    "start_us": int(start),
+                    "end_us": int(end),
+                    "pid": int(pid),
+                    "rc": int(rc),
+                }
+            except ValueError:
+                raise ValueError(f"{path}:{line_num}: malformed span record") from None
+            args = {}
+            for extra in fields[6:]:
+                key, sep, value = extra.partition('=')
+                if sep:
+                    args[key] = _number(value)
+            if args:
+                span["args"] = args
+            spans.append(span)
+    spans.sort(key=lambda s: (s["start_us"], -s["end_us"]))
+    return spans
+
+
+def _number(value: str):
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+
+def build_report(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarise spans as a JSON friendly report with times relative to the first span."""
+    origin = min((s["start_us"] for s in spans), default=0)
+    finish = max((s["end_us"] for s in spans), default=0)
+
+    entries = []
+    categories: Dict[str, float] = {}
+    for s in spans:
+        duration = (s["end_us"] - s["start_us"]) / 1e6
+        entry = {
+            "name": s["name"],
+            "category": s["category"],
+            "start_s": round((s["start_us"] - origin) / 1e6, 6),
+            "duration_s": round(duration, 6),
+            "pid": s["pid"],
+            "rc": s["rc"],
+        }
+        if "args" in s:
+            entry["args"] = s["args"]
+        entries.append(entry)
+        categories[s["category"]] = categories.get(s["category"], 0.0) + duration
+
+    stages = [
+        {"name": e["name"], "duration_s": e["duration_s"], "rc": e["rc"]}
+        for e in entries if e["category"] == "stage"
+    ]
+    slowest = sorted(
+        (e for e in entries if e["category"] != "stage"),
+        key=lambda e: e["duration_s"], reverse=True,
+    )[:10]
+
+    return {
+        "version": 1,
+        "total_s": round((finish - origin) / 1e6, 6),
+        "stages": stages,
+        "categories": {k: round(v, 6) for k, v in sorted(categories.items())},
+        "slowest": [{"name": e["name"], "category": e["category"], "duration_s": e["duration_s"]} for e in slowest],
+        "spans": entries,
+    }
+
+
+def build_chrome_trace(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Convert spans to Chrome trace-event format (complete 'X' events)."""
+    origin = min((s["start_us"] for s in spans), default=0)
+    root_pid = spans[0]["pid"] if spans else 0
+    events = []
+    for s in spans:
+        args = {"rc": s["rc"], **s.get("args", {})}
+        events.append({
+            "name": s["name"],
+            "cat": s["category"],
+            "ph": "X",
+            "ts": s["start_us"] - origin,
+            "dur": s["end_us"] - s["start_us"],
+            "pid": root_pid,
+            "tid": s["pid"],
+            "args": args,
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def Timing_register_parser(subparsers):
+    parser = subparsers.add_parser("timing", help="Build timing report from a span log")
+    parser.add_argument("log", help="Span log written by the span shell helper")
+    parser.add_argument("--out", metavar="FILE", help="Write the report here (default: stdout)")
+    parser.add_argument("--format", choices=["json", "chrome"], default="json",
+                        help="Report format: summary json or Chrome trace-event json")
+    parser.set_defaults(func=_main)
+
+
+def _main(args):
+    try:
+        spans = read_trace_log(args.log)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        raise SystemExit(1)
+
+    payload = build_chrome_trace(spans) if args.format == "chrome" else build_report(spans)
+
+    if not args.out:
+        json.dump(payload, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    tmp = f"{args.out}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, indent=2)
+        f.write('\n')
+    os.replace(tmp, args.out)
@@ -0,0 +1,76 @@
+#!/bin/bash
+
+# Compare sparse image generation paths on an ext4 image.
+#
+#   current:  genimage android-sparse (or img2simg), then zstd as deploy does
+#   in-tree:  img2sparse, then zstd
+#   stream:   img2sparse --zstd, sparse and compress in one pass
+#
+# Usage: sparse-bench.sh [IMAGE_SIZE] [DATA_SIZE] [WORKDIR]
+#   defaults 4G, 1G and a temporary dir. Needs mkfs.ext4 and zstd; the
+#   current path is skipped if neither genimage nor img2simg is installed.
+
+set -eu
+
+IGTOP=$(readlink -f "$(dirname "$0")/../../")
+PATH="${IGTOP}/bin:$PATH"
+
+SIZE=${1:-4G}
+DATA=${2:-1G}
+WORK=${3:-}
+if [[ -z $WORK ]] ; then
+   WORK=$(mktemp -d)
+   trap 'rm -rf "$WORK"' EXIT
+fi
+mkdir -p "$WORK/tree" "$WORK/out"
+
+# Half incompressible, half text-like, split over a few files
+half=$(( $(numfmt --from=iec "$DATA") / 2 ))
+head -c "$half" /dev/urandom | split -b 64M - "$WORK/tree/rand."
+yes "rpi-image-gen sparse benchmark" | head -c "$half" | split -b 64M - "$WORK/tree/text."
+truncate -s "$SIZE" "$WORK/raw.img"
+mkfs.ext4 -q -F -d "$WORK/tree" "$WORK/raw.img"
+sync "$WORK/raw.img"
+rm -rf "$WORK/tree"
+
+report() {
+   local name=$1 start=$2 file=$3
+   printf '%-10s %8.2fs %10s  %s\n' "$name" "$(awk "BEGIN { print $EPOCHREALTIME - $start }")" \
+      "$(du -h --apparent-size "$file" | cut -f1)" "$(basename "$file")"
+}
+
+echo "image $(du -h --apparent-size "$WORK/raw.img" | cut -f1), allocated $(du -h "$WORK/raw.img" | cut -f1)"
+
+if command -v genimage > /dev/null ; then
+   cat > "$WORK/genimage.cfg" <<-CFG
+	image current.sparse {
+	   android-sparse {
+	      image = raw.img
+	   }
+	}
+	CFG
+   t=$EPOCHREALTIME
+   genimage --rootpath "$WORK" --tmppath "$WORK/gtmp" --inputpath "$WORK" \
+      --outputpath "$WORK/out" --config "$WORK/genimage.cfg" > /dev/null 2>&1
+   zstd -q -f "$WORK/out/current.sparse"
+   report current "$t" "$WORK/out/current.sparse.zst"
+elif command -v img2simg > /dev/null ; then
+   t=$EPOCHREALTIME
+   img2simg "$WORK/raw.img" "$WORK/out/current.sparse"
+   zstd -q -f "$WORK/out/current.sparse"
+   report current "$t" "$WORK/out/current.sparse.zst"
+else
+   echo "current    skipped, neither genimage nor img2simg installed"
+fi
+
+t=$EPOCHREALTIME
+img2sparse "$WORK/raw.img" "$WORK/out/intree.sparse" > /dev/null
+zstd -q -f "$WORK/out/intree.sparse"
+report in-tree "$t" "$WORK/out/intree.sparse.zst"
+
+t=$EPOCHREALTIME
+img2sparse --zstd "$WORK/raw.img" "$WORK/out/stream.sparse.zst" > /dev/null
+report stream "$t" "$WORK/out/stream.sparse.zst"
+
+zstd -q -d -c "$WORK/out/stream.sparse.zst" | cmp -s - "$WORK/out/intree.sparse" \
+   || { echo "stream and in-tree outputs differ" ; exit 1 ; }
@@ -0,0 +1,2 @@
+# Put this directory's parent on PYTHONPATH to prove jsonschema is not imported
+raise ImportError("jsonschema imported")
@@ -5,6 +5,7 @@
 
 IGTOP=$(readlink -f "$(dirname "$0")/../../")
 
+IDP="${IGTOP}/test/idp"
 SCHEMA="${IGTOP}/layer/rpi/schemas/provisionmap/v1/schema.json"
 PATH="${IGTOP}/bin:$PATH"
 
@@ -54,6 +55,28 @@ print_fail() {
     FAILED_TEST_NAMES+=("$1")
 }
 
+run_test() {
+    local test_name="$1"
+    local command="$2"
+    local expected_exit_code="$3"
+    local description="$4"
+
+    ((TOTAL_TESTS++))
+    print_test "$test_name"
+
+    local output
+    output=$(eval "$command" 2>&1)
+    local actual_exit_code=$?
+
+    if [ "$actual_exit_code" -eq "$expected_exit_code" ]; then
+        print_pass "$description"
+    else
+        print_fail "$description" "Expected exit code $expected_exit_code, got $actual_exit_code. Output: $output"
+    fi
+
+    echo ""
+}
+
 print_summary() {
     echo -e "${BLUE}================================${NC}"
     echo -e "${BLUE}TEST SUMMARY${NC}"
@@ -99,4 +122,38 @@ while IFS= read -r -d '' pmap; do
     echo ""
 done < <(find "${IGTOP}/image" -name 'provisionmap-*.json' -print0 | sort -z)
 
+print_header "PMAP QUERIES"
+
+run_test "pmap-batch-queries" \
+    "python3 ${IDP}/test_pmap.py batch-queries" \
+    0 \
+    "pmap should answer several queries and emit all shell variables from one invocation"
+
+run_test "pmap-schema-cache" \
+    "python3 ${IDP}/test_pmap.py schema-cache" \
+    0 \
+    "pmap should skip jsonschema for a schema checked on an earlier run and still report errors"
+
+run_test "pmap-schema-cache-unsupported" \
+    "python3 ${IDP}/test_pmap.py schema-cache-unsupported" \
+    0 \
+    "pmap should keep using jsonschema when positional items use keywords the fast path lacks"
+
+print_header "IMAGE TOOLS"
+
+run_test "image2json-native-ptable" \
+    "python3 ${IDP}/test_image2json.py native-ptable" \
+    0 \
+    "image2json should read GPT, MBR and sparse headers from the images without external tools"
+
+run_test "image2json-partition-digests" \
+    "python3 ${IDP}/test_image2json.py partition-digests" \
+    0 \
+    "image2json should record chunked content digests per partition image"
+
+run_test "idp-delta-flash" \
+    "python3 ${IDP}/test_idp_delta.py" \
+    0 \
+    "idp.sh delta mode should flash only changed chunks and skip unchanged images"
+
 print_summary
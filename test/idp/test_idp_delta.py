@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Tests for idp.sh delta flashing against a fake fastboot gadget.
+
+fixtures/fastboot stands in for the device: its partitions are files in a
+temporary directory and it logs how many bytes each flash wrote.
+"""
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import tempfile
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+IDP_SH = REPO_ROOT / "bin" / "idp.sh"
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+
+MB = 1 << 20
+
+
+def write_sparse(path: Path, data: bytes) -> None:
+    """Write data as a single raw chunk Android sparse image."""
+    blocks = -(-len(data) // 4096)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHHHIIII", 0xed26ff3a, 1, 0, 28, 12, 4096, blocks, 1, 0))
+        f.write(struct.pack("<HHII", 0xcac1, 0, blocks, 12 + blocks * 4096))
+        f.write(data + bytes(blocks * 4096 - len(data)))
+
+
+def write_output(outdir: Path, images) -> Path:
+    """Write images, their sparse forms and a digest carrying image.json."""
+    outdir.mkdir()
+    parts = {}
+    for pname, (name, data) in images.items():
+        (outdir / name).write_bytes(data)
+        sname = name.split(".")[0] + ".sparse"
+        write_sparse(outdir / sname, data)
+        chunks = [hashlib.sha256(data[o:o + MB]).digest() for o in range(0, len(data), MB)]
+        parts[pname] = {"name": pname, "image": name, "simage": sname, "size": 16 * MB,
+                        "digest": {"algorithm": "sha256", "size": len(data), "chunk-size": MB,
+                                   "root": hashlib.sha256(b"".join(chunks)).hexdigest(),
+                                   "chunks": [c.hex() for c in chunks]}}
+    doc = {"IGmeta": {"IGconf_image_outputdir": str(outdir)},
+           "layout": {"partitionimages": parts,
+                      "provisionmap": [{"attributes": {"PMAPversion": "1.0.0"}}]}}
+    path = outdir / "image.json"
+    path.write_text(json.dumps(doc))
+    return path
+
+
+def idp(dev: Path, *args: str) -> tuple:
+    env = dict(os.environ, FAKEDEV=str(dev), PATH=f"{FIXTURES_DIR}:{os.environ['PATH']}")
+    res = subprocess.run([str(IDP_SH), *args], env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, text=True)
+    if res.returncode != 0:
+        raise SystemExit(f"idp.sh {' '.join(args)} failed: {res.stdout}")
+    (dev / ".served").unlink()
+    log = (dev / ".log").read_text().split("\n")
+    (dev / ".log").unlink()
+    return res.stdout, sorted(line for line in log if line)
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory(prefix="idp-delta-") as tmpdir:
+        top = Path(tmpdir)
+        boot = os.urandom(8 * MB)
+        system = os.urandom(6 * MB) + b"x" * 1000
+        newboot = bytearray(boot)
+        newboot[3 * MB + 5] ^= 0xff
+        newboot[7 * MB:7 * MB + 10] = b"0123456789"
+
+        old = write_output(top / "old", {"boot": ("boot.vfat", boot), "system": ("system.ext4", system)})
+        new = write_output(top / "new", {"boot": ("boot.vfat", bytes(newboot)), "system": ("system.ext4", system)})
+        dev = top / "dev"
+        dev.mkdir()
+        for name, data in (("boot", boot), ("system", system)):
+            with open(dev / name, "wb") as f:
+                f.write(data)
+                f.truncate(16 * MB)
+
+        # Only the two changed 1M chunks of boot are written
+        out, log = idp(dev, "-f", str(new), "-b", str(old))
+        if "system.sparse: unchanged" not in out:
+            raise SystemExit(f"unchanged system image was not skipped: {out}")
+        if log != ["boot 2097152"]:
+            raise SystemExit(f"delta flash wrote {log}, expected two boot chunks")
+        if (dev / "boot").read_bytes()[:len(newboot)] != bytes(newboot):
+            raise SystemExit("boot partition does not match the new image after delta flash")
+
+        # Without a base everything is flashed in full
+        _, log = idp(dev, "-f", str(new))
+        if log != ["boot 8388608", "system 6295552"]:
+            raise SystemExit(f"full flash wrote {log}")
+
+
+if __name__ == "__main__":
+    main()
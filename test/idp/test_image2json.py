@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Tests for bin/image2json reading partition tables and images natively.
+
+Each case builds a small genimage output directory (config, disk image and
+partition images) and checks the layout image2json reports for it.
+Usage: test_image2json.py [CASE...]
+"""
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import uuid
+import zlib
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+IMAGE2JSON = REPO_ROOT / "bin" / "image2json"
+PMAP = REPO_ROOT / "bin" / "pmap"
+IDP_SCHEMA = REPO_ROOT / "layer" / "rpi" / "schemas" / "idp" / "v2" / "schema.json"
+
+SPARSE_MAGIC = 0xed26ff3a
+
+PTABLE_CFG = """
+image root.sparse {{
+   android-sparse {{
+      image = root.ext4
+   }}
+}}
+image disk.img {{
+   hdimage {{
+      align = 1M
+      partition-table-type = "{table}"
+   }}
+   partition boot {{
+      image = boot.vfat
+      partition-type-uuid = F
+   }}
+   partition root {{
+      image = root.ext4
+      partition-type-uuid = L
+   }}
+}}
+image boot.vfat {{
+   vfat {{
+      label = "BOOT"
+      extraargs = "-i 1234ABCD"
+   }}
+}}
+image root.ext4 {{
+   ext4 {{
+      extraargs = "-U 0fc63daf-8483-4772-8e79-3d69d8477de4"
+   }}
+}}
+"""
+
+DIGEST_CFG = """
+image disk.img {
+   hdimage {
+      partition-table-type = "mbr"
+   }
+   partition boot_a {
+      image = boot.vfat
+   }
+   partition boot_b {
+      image = boot.vfat
+   }
+}
+image boot.sparse {
+   android-sparse {
+      image = boot.vfat
+   }
+}
+image boot.vfat {
+   vfat {
+      label = "BOOT"
+   }
+}
+"""
+
+DIGEST_ENV = {
+    "IGconf_device_class": "pi5",
+    "IGconf_device_variant": "none",
+    "IGconf_device_storage_type": "sd",
+    "IGconf_image_version": "1",
+}
+
+
+def run(out: str, *args: str, **env: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, IGconf_image_outputdir=out, IGconf_device_sector_size="512", **env)
+    return subprocess.run([str(IMAGE2JSON), "-g", os.path.join(out, "genimage.cfg"), *args],
+                          env=env, capture_output=True, text=True)
+
+
+def layout(out: str, *args: str, **env: str) -> dict:
+    res = run(out, *args, **env)
+    if res.returncode != 0:
+        raise SystemExit(f"image2json failed: {res.stderr}")
+    return json.loads(res.stdout)["layout"]
+
+
+def write_sparse_header(path: str, blocks: int) -> None:
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHHHIIII", SPARSE_MAGIC, 1, 0, 28, 12, 4096, blocks, 1, 0))
+
+
+def write_disk(path: str, head: bytes, sectors: int) -> None:
+    with open(path, "wb") as f:
+        f.write(head)
+        f.truncate(sectors * 512)
+
+
+def mbr(disk_id: int, parts) -> bytes:
+    """Return an MBR sector with (boot flag, type, first LBA, sectors) entries."""
+    sector = bytearray(512)
+    struct.pack_into("<I", sector, 440, disk_id)
+    for i, (flag, ptype, first, count) in enumerate(parts):
+        struct.pack_into("<B3xB3xII", sector, 446 + i * 16, flag, ptype, first, count)
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def gpt(disk_guid: uuid.UUID, parts) -> bytes:
+    """Return a protective MBR, primary GPT header and entry array (no backup)."""
+    entries = bytearray(128 * 128)
+    basic_data = uuid.UUID("EBD0A0A2-B9E5-4433-87C0-68B6B72699C7")
+    for i, (first, last, name) in enumerate(parts):
+        struct.pack_into("<16s16sQQQ72s", entries, i * 128, basic_data.bytes_le,
+                         uuid.UUID(int=i + 1).bytes_le, first, last, 0, name.encode("utf-16-le"))
+    hdr = bytearray(struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x10000, 92, 0, 0, 1, 8191, 34, 8158,
+                                disk_guid.bytes_le, 2, 128, 128, zlib.crc32(entries)))
+    struct.pack_into("<I", hdr, 16, zlib.crc32(hdr))
+    return mbr(0, [(0, 0xee, 1, 8191)]) + bytes(hdr) + bytes(512 - len(hdr)) + bytes(entries)
+
+
+def case_native_ptable() -> None:
+    # GPT, MBR and sparse headers are read from the images themselves
+    with tempfile.TemporaryDirectory(prefix="image2json-") as out:
+        cfg = os.path.join(out, "genimage.cfg")
+        disk = os.path.join(out, "disk.img")
+        sparse = os.path.join(out, "root.sparse")
+        for name in ("boot.vfat", "root.ext4"):
+            open(os.path.join(out, name), "wb").close()
+
+        disk_guid = uuid.UUID("11111111-2222-3333-4444-555555555555")
+        Path(cfg).write_text(PTABLE_CFG.format(table="gpt"))
+        write_disk(disk, gpt(disk_guid, [(2048, 4095, "boot"), (4096, 8191, "root")]), 8192)
+        write_sparse_header(sparse, 512)
+        doc = layout(out)
+        if doc["partitiontable"] != {"label": "gpt", "id": str(disk_guid).upper()}:
+            raise SystemExit(f"unexpected GPT partition table {doc['partitiontable']}")
+        boot, root = doc["partitionimages"]["boot"], doc["partitionimages"]["root"]
+        if (boot["size"], root["size"]) != (2048 * 512, 4096 * 512):
+            raise SystemExit("GPT partition sizes not read from the entry array")
+        if (boot["partition-label"], root["partition-label"]) != ("boot", "root"):
+            raise SystemExit("GPT partition names not read from the entry array")
+        if root["partition-uuid"] != "00000000-0000-0000-0000-000000000002":
+            raise SystemExit(f"unexpected GPT partition uuid {root['partition-uuid']}")
+        if root["simage"] != "root.sparse" or boot["fs_uuid"] != "1234-ABCD":
+            raise SystemExit("sparse image or vfat id missing from the layout")
+
+        # A sparse image that does not fit its partition is rejected
+        write_sparse_header(sparse, 513)
+        if run(out).returncode == 0:
+            raise SystemExit("oversized sparse image was accepted")
+
+        # A corrupted GPT header is rejected
+        write_sparse_header(sparse, 512)
+        with open(disk, "r+b") as f:
+            f.seek(512 + 40)
+            f.write(b"\xff")
+        if run(out).returncode == 0:
+            raise SystemExit("corrupted GPT header was accepted")
+
+        Path(cfg).write_text(PTABLE_CFG.format(table="mbr"))
+        write_disk(disk, mbr(0xdeadbeef, [(0x80, 0x0c, 2048, 2048), (0, 0x83, 4096, 4096)]), 8192)
+        doc = layout(out)
+        if doc["partitiontable"] != {"label": "dos", "id": "0xdeadbeef"}:
+            raise SystemExit(f"unexpected MBR partition table {doc['partitiontable']}")
+        if doc["partitionimages"]["root"]["size"] != 4096 * 512:
+            raise SystemExit("MBR partition size not read from the partition entry")
+
+
+def case_partition_digests() -> None:
+    # -d records chunked sha256 digests per partition image, once per image
+    with tempfile.TemporaryDirectory(prefix="image2json-") as out:
+        Path(out, "genimage.cfg").write_text(DIGEST_CFG)
+        write_sparse_header(os.path.join(out, "boot.sparse"), 1025)
+        write_disk(os.path.join(out, "disk.img"),
+                   mbr(0, [(0, 0x0c, 2048, 16384), (0, 0x0c, 18432, 16384)]), 40000)
+        data = os.urandom(3 << 20) + bytes(1 << 20) + b"tail"
+        Path(out, "boot.vfat").write_bytes(data)
+
+        res = run(out, "-d", "1M", "-j", "3", **DIGEST_ENV)
+        if res.returncode != 0:
+            raise SystemExit(f"image2json -d failed: {res.stderr}")
+        Path(out, "image.json").write_text(res.stdout)
+        parts = json.loads(res.stdout)["layout"]["partitionimages"]
+        digest = parts["boot_a"]["digest"]
+        if parts["boot_b"]["digest"] != digest:
+            raise SystemExit("partitions sharing an image have different digests")
+        if digest["size"] != len(data) or digest["chunk-size"] != 1 << 20:
+            raise SystemExit(f"unexpected digest size/chunk-size {digest['size']}/{digest['chunk-size']}")
+        chunks = [hashlib.sha256(data[o:o + (1 << 20)]).digest() for o in range(0, len(data), 1 << 20)]
+        if digest["chunks"] != [c.hex() for c in chunks] or len(chunks) != 5:
+            raise SystemExit("chunk digests do not match the image content")
+        if digest["root"] != hashlib.sha256(b"".join(chunks)).hexdigest():
+            raise SystemExit("root digest does not cover the chunk digests")
+
+        res = subprocess.run([str(PMAP), "--schema", str(IDP_SCHEMA), "--file", os.path.join(out, "image.json")],
+                             capture_output=True, text=True)
+        if res.returncode != 0:
+            raise SystemExit(f"image.json with digests fails the IDP schema: {res.stderr}")
+
+        # Without -d nothing is added
+        if "digest" in layout(out, **DIGEST_ENV)["partitionimages"]["boot_a"]:
+            raise SystemExit("digest recorded without -d")
+
+        # Chunks must be whole 4K blocks
+        for bad in ("1K", "6K"):
+            if run(out, "-d", bad, **DIGEST_ENV).returncode == 0:
+                raise SystemExit(f"chunk size {bad} was accepted")
+
+
+CASES = {
+    "native-ptable": case_native_ptable,
+    "partition-digests": case_partition_digests,
+}
+
+
+def main() -> None:
+    for name in sys.argv[1:] or CASES:
+        CASES[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Tests for bin/pmap queries and schema validation.
+
+Cases run pmap on the ab_userdata crypt provisioning map, with its template
+variables filled in from the same dummy values as the PMAP validation tests.
+Usage: test_pmap.py [CASE...]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+PMAP = REPO_ROOT / "bin" / "pmap"
+SCHEMA = REPO_ROOT / "layer" / "rpi" / "schemas" / "provisionmap" / "v1" / "schema.json"
+PROVISIONMAP = REPO_ROOT / "image" / "gpt" / "ab_userdata" / "device" / "provisionmap-crypt.json"
+NO_JSONSCHEMA = Path(__file__).resolve().parent / "fixtures" / "nojsonschema"
+
+TEMPLATE_VARS = {
+    "BOOT_UUID": "ABCD-1234",
+    "SYSTEM_UUID": "00000000-0000-0000-0000-000000000002",
+    "CRYPT_UUID": "00000000-0000-0000-0000-000000000003",
+    "LUKS_CIPHER": "aes-xts-plain64",
+    "LUKS_KEYSIZE": "512",
+    "LUKS_HASH": "sha256",
+}
+
+
+def write_provisionmap(path: Path) -> Path:
+    text = PROVISIONMAP.read_text()
+    for name, value in TEMPLATE_VARS.items():
+        text = text.replace(f"${{{name}}}", value)
+    path.write_text(text)
+    return path
+
+
+def pmap(*args: str, **env: str) -> subprocess.CompletedProcess:
+    base = {k: v for k, v in os.environ.items() if k not in ("PMAP_CACHE_DIR", "IGconf_sys_cachedir")}
+    return subprocess.run([str(PMAP), *args], env=dict(base, **env), capture_output=True, text=True)
+
+
+def case_batch_queries() -> None:
+    # One invocation answers every --get-key and emits the shell variables
+    with tempfile.TemporaryDirectory(prefix="pmap-") as tmpdir:
+        top = Path(tmpdir)
+        pm = str(write_provisionmap(top / "pmap.json"))
+
+        res = pmap("--schema", str(SCHEMA), "--file", pm, "--emit-shell",
+                   "--get-key", "0.attributes.PMAPversion", "--get-key", "0.attributes.system_type")
+        if res.returncode != 0:
+            raise SystemExit(f"pmap --emit-shell failed: {res.stderr}")
+        (top / "vars").write_text(res.stdout)
+        shell = subprocess.run(
+            ["sh", "-c", '. "$1" && printf "%s\\n" "$CONTAINERS" "$osdata_crypt_ETYPE" '
+             '"$SLOT_A_BOOT" "$SLOT_B_SYSTEM" "$_0_attributes_system_type"', "_", str(top / "vars")],
+            capture_output=True, text=True)
+        if shell.stdout.split("\n")[:5] != ["osdata_crypt", "partitioned", "::2",
+                                            "mapper:osdata_crypt:2", "slotted"]:
+            raise SystemExit(f"unexpected shell variables: {shell.stdout} {shell.stderr}")
+
+        # A missing key prints an empty line in its place and fails the run
+        res = pmap("--file", pm, "--get-key", "0.attributes.system_type", "--get-key", "0.nokey",
+                   "--get-key", "0.attributes.PMAPversion")
+        if res.stdout.split("\n") != ["slotted", "", "1.5.0", ""]:
+            raise SystemExit(f"unexpected batched query output {res.stdout!r}")
+        if pmap("--file", pm, "--get-key", "0.nokey").returncode == 0:
+            raise SystemExit("a missing key did not fail")
+
+        # Keys outside the provisioning map are reachable
+        idp = top / "idp.json"
+        idp.write_text('{"IGmeta": {"IGconf_image_outputdir": "/x y"}, "layout": {"provisionmap": []}}')
+        res = pmap("--file", str(idp), "--get-key", "IGmeta.IGconf_image_outputdir")
+        if res.stdout != "/x y\n":
+            raise SystemExit(f"unexpected IGmeta lookup {res.stdout!r}")
+
+        # Every --schema is applied and a failure names the schema
+        res = pmap("--schema", str(SCHEMA), "--schema", str(SCHEMA), "--file", str(idp))
+        if res.returncode == 0 or f"schema: {SCHEMA}" not in res.stderr:
+            raise SystemExit(f"repeated --schema did not report the failing schema: {res.stderr}")
+
+
+def case_schema_cache() -> None:
+    # A schema checked on an earlier run is validated without jsonschema
+    with tempfile.TemporaryDirectory(prefix="pmap-") as tmpdir:
+        top = Path(tmpdir)
+        pm = str(write_provisionmap(top / "pmap.json"))
+        bad = top / "bad.json"
+        bad.write_text(Path(pm).read_text().replace(TEMPLATE_VARS["SYSTEM_UUID"], "not-a-uuid"))
+        cache = top / "cache"
+
+        if pmap("--schema", str(SCHEMA), "--file", pm, PYTHONPATH=str(NO_JSONSCHEMA)).returncode == 0:
+            raise SystemExit("validation without a cache did not need jsonschema")
+        res = pmap("--schema", str(SCHEMA), "--file", pm, "--cache-dir", str(cache))
+        if res.returncode != 0:
+            raise SystemExit(f"pmap --cache-dir failed: {res.stderr}")
+        markers = list(cache.glob("schema-*.json"))
+        if len(markers) != 1 or markers[0].read_text() != '{"checked": true, "fast": true}':
+            raise SystemExit(f"unexpected schema cache {[m.read_text() for m in markers]}")
+
+        res = pmap("--schema", str(SCHEMA), "--file", pm, "--get-key", "0.attributes.system_type",
+                   PYTHONPATH=str(NO_JSONSCHEMA), PMAP_CACHE_DIR=str(cache))
+        if res.returncode != 0 or res.stdout != "slotted\n":
+            raise SystemExit(f"cached validation imported jsonschema: {res.stderr}")
+
+        # Invalid input is still reported
+        res = pmap("--schema", str(SCHEMA), "--file", str(bad), PMAP_CACHE_DIR=str(cache))
+        if res.returncode == 0 or "Error: schema validation failed" not in res.stderr:
+            raise SystemExit(f"cached validation accepted an invalid map: {res.stderr}")
+
+        # The cache defaults to the build cache dir
+        res = pmap("--schema", str(SCHEMA), "--file", pm, IGconf_sys_cachedir=str(top / "sys"))
+        if res.returncode != 0 or not list((top / "sys" / "pmap").glob("schema-*.json")):
+            raise SystemExit("schema cache not written under IGconf_sys_cachedir")
+
+
+def case_schema_cache_unsupported() -> None:
+    # Keywords the built-in validator lacks, even inside positional items,
+    # keep every run on jsonschema
+    with tempfile.TemporaryDirectory(prefix="pmap-") as tmpdir:
+        top = Path(tmpdir)
+        schema = top / "schema.json"
+        schema.write_text('{"type": "array", "items": [{"type": "object"}, '
+                          '{"type": "array", "uniqueItems": true}]}')
+        doc = top / "doc.json"
+        doc.write_text("[{}, [1, 1]]")
+        for run in ("first", "cached"):
+            res = pmap("--schema", str(schema), "--file", str(doc), "--cache-dir", str(top / "cache"))
+            if "Error: schema validation failed" not in res.stderr:
+                raise SystemExit(f"{run} run accepted non-unique items: {res.stderr}")
+        marker = next((top / "cache").glob("schema-*.json")).read_text()
+        if marker != '{"checked": true, "fast": false}':
+            raise SystemExit(f"schema with uniqueItems marked for the fast path: {marker}")
+
+
+CASES = {
+    "batch-queries": case_batch_queries,
+    "schema-cache": case_schema_cache,
+    "schema-cache-unsupported": case_schema_cache_unsupported,
+}
+
+
+def main() -> None:
+    for name in sys.argv[1:] or CASES:
+        CASES[name]()
+
+
+if __name__ == "__main__":
+    main()
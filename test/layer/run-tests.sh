@@ -968,6 +968,510 @@ run_test "variable-dependency-order-robust" \
     "Variables should be in correct dependency order and shell-sourceable with strict error checking"
 
 
+cleanup_env
+run_test "pipeline-anchor-expansion" \
+    'TMP_ENV=$(mktemp) && TMP_OUT=$(mktemp) && TMP_DIR=$(mktemp -d) && \
+     cat > "${TMP_DIR}/anchor-base.yaml" << "EOF" &&
+# METABEGIN
+# X-Env-Layer-Name: test-anchor-base
+# X-Env-Layer-Desc: Anchor expansion test layer
+# X-Env-Layer-Version: 1.0.0
+# X-Env-Layer-Category: test
+# X-Env-VarPrefix: anc
+# X-Env-Var-root: /test/anchor
+# X-Env-Var-root-Desc: Anchored root
+# X-Env-Var-root-Anchor: @ANCROOT
+# X-Env-Var-root-Set: y
+# X-Env-Var-sub: ${@ANCROOT}/sub
+# X-Env-Var-sub-Desc: Upper case reference
+# X-Env-Var-sub-Set: y
+# X-Env-Var-alt: ${@ancroot}/alt
+# X-Env-Var-alt-Desc: Lower case reference
+# X-Env-Var-alt-Set: y
+# METAEND
+EOF
+     make_pipeline_env "$TMP_ENV" && \
+     ig pipeline --env-in "$TMP_ENV" --layers test-anchor-base --path "$TMP_DIR" \
+        --env-out "$TMP_OUT" >/dev/null && \
+     grep -q "^IGconf_anc_sub=/test/anchor/sub$" "$TMP_OUT" && \
+     grep -q "^IGconf_anc_alt=/test/anchor/alt$" "$TMP_OUT"; RESULT=$?; \
+     rm -rf "$TMP_ENV" "$TMP_OUT" "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Pipeline should expand layer anchors regardless of reference case"
+
+
+cleanup_env
+run_test "anchor-manifest-references" \
+    'TMP_DIR=$(mktemp -d) && \
+     printf "%s\n" "A=\${@ROOT}/a:\${@ROOT}/b" "B=\${@root}/c" > "${TMP_DIR}/in.env" && \
+     ig resolve --env-in "${TMP_DIR}/in.env" --env-out "${TMP_DIR}/out.env" \
+        --anchors-out "${TMP_DIR}/anchors.json" && \
+     python3 -c "import json,sys; a=json.load(open(sys.argv[1]))[\"anchors\"][\"@ROOT\"]; sys.exit(a[\"references\"] != {\"A\": 2, \"B\": 1})" \
+        "${TMP_DIR}/anchors.json"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Anchor manifest should count references to each anchor per variable"
+
+
+cleanup_env
+run_test "pipeline-final-out-posix" \
+    'TMP_ENV=$(mktemp) && TMP_OUT=$(mktemp) && TMP_FINAL=$(mktemp) && \
+     make_pipeline_env "$TMP_ENV" "IGconf_x_hash=\$6\$salt\$hash" "IGconf_x_cmd=\${IGconf_x_hash}:\$(echo sub)" && \
+     ig pipeline --env-in "$TMP_ENV" --layers test-basic --path '"${PIPELINE_LAYER_DIR}"' \
+        --env-out "$TMP_OUT" --final-out "$TMP_FINAL" >/dev/null && \
+     grep -qxF "IGconf_x_hash=\"\$6\$salt\$hash\"" "$TMP_FINAL" && \
+     grep -qxF "IGconf_x_cmd=\"\$6\$salt\$hash:sub\"" "$TMP_FINAL" && \
+     grep -qxF "IGconf_basic_port=\"8080\"" "$TMP_FINAL"; RESULT=$?; \
+     rm -f "$TMP_ENV" "$TMP_OUT" "$TMP_FINAL"; \
+     exit $RESULT' \
+    0 \
+    "Pipeline should write a POSIX expanded final env keeping literal \$ sequences"
+
+cleanup_env
+run_test "posix-expand-nested" \
+    'TMP_DIR=$(mktemp -d) && \
+     cat > "${TMP_DIR}/env" << "EOF" &&
+B=bee.tar.gz
+X=${A:-${B}}x
+Y=${A:-${C:-${B%%.*}}}
+Z=${B:+$(printf %s ${#B})}
+W=$(echo "${B##*.}" $B)
+V=${B%.*}:${B#*.}:${A+set}
+EOF
+     cat > "${TMP_DIR}/expect" << "EOF" &&
+bee.tar.gz
+bee.tar.gzx
+bee
+10
+"gz" $B
+bee.tar:tar.gz:
+EOF
+     python3 -c "import sys; sys.path.insert(0, sys.argv[1]); from env_resolver import posix_expand; \
+        env = dict(l.rstrip(\"\n\").split(\"=\", 1) for l in open(sys.argv[2])); \
+        print(\"\n\".join(posix_expand(env).values()))" "${IGTOP}/site" "${TMP_DIR}/env" > "${TMP_DIR}/py.out" && \
+     cmp -s "${TMP_DIR}/expect" "${TMP_DIR}/py.out" && \
+     printf "%s\n" "B=\${B/e/x}" > "${TMP_DIR}/env" && \
+     python3 -c "import sys; sys.path.insert(0, sys.argv[1]); from env_resolver import posix_expand; \
+        posix_expand(dict(l.rstrip(\"\n\").split(\"=\", 1) for l in open(sys.argv[2])))" \
+        "${IGTOP}/site" "${TMP_DIR}/env" 2>&1 | grep -q "Unsupported parameter expansion"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "POSIX expansion should match the escaped sh path for parameter forms and command substitutions"
+
+cleanup_env
+run_test "pipeline-final-out-cmd-fail" \
+    'TMP_ENV=$(mktemp) && TMP_OUT=$(mktemp) && TMP_FINAL=$(mktemp) && \
+     make_pipeline_env "$TMP_ENV" "IGconf_x_cmd=\$(exit 3)" && \
+     ig pipeline --env-in "$TMP_ENV" --layers test-basic --path '"${PIPELINE_LAYER_DIR}"' \
+        --env-out "$TMP_OUT" --final-out "$TMP_FINAL" >/dev/null 2>&1; RESULT=$?; \
+     rm -f "$TMP_ENV" "$TMP_OUT" "$TMP_FINAL"; \
+     exit $RESULT' \
+    1 \
+    "Pipeline should fail when a command substitution in the final env fails"
+
+cleanup_env
+run_test "config-diamond-include-cache" \
+    'TMP_DIR=$(mktemp -d) && \
+     printf "device:\n  x: 0\n  y: 2\n" > "${TMP_DIR}/base.yaml" && \
+     printf "include:\n  file: base.yaml\nimage:\n  a: 1\n" > "${TMP_DIR}/a.yaml" && \
+     printf "include:\n  file: base.yaml\nimage:\n  b: 1\n" > "${TMP_DIR}/b.yaml" && \
+     printf "include: [a.yaml, b.yaml]\ndevice:\n  x: 1\n" > "${TMP_DIR}/top.yaml" && \
+     ig config "${TMP_DIR}/top.yaml" --cache-dir "${TMP_DIR}/cache" --write-to "${TMP_DIR}/one.env" >/dev/null 2>&1 && \
+     ls "${TMP_DIR}"/cache/config-*.json >/dev/null && \
+     ig config "${TMP_DIR}/top.yaml" --cache-dir "${TMP_DIR}/cache" --write-to "${TMP_DIR}/two.env" >/dev/null 2>&1 && \
+     cmp -s "${TMP_DIR}/one.env" "${TMP_DIR}/two.env" && \
+     grep -qxF "IGconf_device_x=\"1\"" "${TMP_DIR}/two.env" && \
+     printf "device:\n  x: 0\n  y: 5\n" > "${TMP_DIR}/base.yaml" && \
+     ig config "${TMP_DIR}/top.yaml" --cache-dir "${TMP_DIR}/cache" --write-to "${TMP_DIR}/two.env" >/dev/null 2>&1 && \
+     grep -qxF "IGconf_device_y=\"5\"" "${TMP_DIR}/two.env"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Config should load diamond includes and only reuse the cache while includes are unchanged"
+cleanup_env
+run_test "config-why-provenance" \
+    'TMP_DIR=$(mktemp -d) && \
+     printf "device:\n  x: 0\n  y: 2\n" > "${TMP_DIR}/base.yaml" && \
+     printf "include:\n  file: base.yaml\ndevice:\n  x: 1\n" > "${TMP_DIR}/top.yaml" && \
+     printf "IGconf_device_y=5\n" > "${TMP_DIR}/ovr.env" && \
+     WHY=$(ig config "${TMP_DIR}/top.yaml" --why IGconf_device_x) && \
+     echo "$WHY" | grep -qxF "IGconf_device_x=1 (config)" && \
+     echo "$WHY" | grep -qF "[config] ${TMP_DIR}/top.yaml:4: '"'"'1'"'"'" && \
+     echo "$WHY" | grep -qF "[shadowed] ${TMP_DIR}/base.yaml:2: '"'"'0'"'"'" && \
+     ig config "${TMP_DIR}/top.yaml" --overrides "${TMP_DIR}/ovr.env" --why device.y | grep -qxF "IGconf_device_y=5 (override)" && \
+     ! ig config "${TMP_DIR}/top.yaml" --why IGconf_device_z 2>/dev/null; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Config --why should report the winning source and the definitions it shadows"
+cleanup_env
+run_test "timing-report-formats" \
+    'TMP_LOG=$(mktemp) && TMP_OUT=$(mktemp) && \
+     ( source "${IGTOP}/lib/common.sh" && export IG_TRACE_LOG="$TMP_LOG" && \
+       span outer stage bash -c "span inner ig true; span bad hook false" ); \
+     [ "$(wc -l < "$TMP_LOG")" -eq 3 ] && \
+     ig timing "$TMP_LOG" --out "$TMP_OUT" && \
+     python3 -c "import json,sys; r=json.load(open(sys.argv[1])); assert [s[\"name\"] for s in r[\"stages\"]] == [\"outer\"] and r[\"stages\"][0][\"rc\"] == 1 and set(r[\"categories\"]) == {\"stage\",\"ig\",\"hook\"}" "$TMP_OUT" && \
+     ig timing "$TMP_LOG" --format chrome --out "$TMP_OUT" && \
+     python3 -c "import json,sys; e=json.load(open(sys.argv[1]))[\"traceEvents\"]; assert len(e) == 3 and all(x[\"ph\"] == \"X\" for x in e)" "$TMP_OUT"; RESULT=$?; \
+     rm -f "$TMP_LOG" "$TMP_OUT"; \
+     exit $RESULT' \
+    0 \
+    "Span log should convert to a timing report and a Chrome trace"
+cleanup_env
+run_test "hookstat-accounting" \
+    'TMP_DIR=$(mktemp -d) && \
+     hookstat --name ok-hook --phase customize --log "${TMP_DIR}/hooks.jsonl" --summary "${TMP_DIR}/sum" -- true && \
+     hookstat --name bad-hook --phase customize --log "${TMP_DIR}/hooks.jsonl" --summary "${TMP_DIR}/sum" -- sh -c "exit 4"; \
+     [ $? -eq 4 ] && [ "$(wc -l < "${TMP_DIR}/sum")" -eq 2 ] && \
+     python3 -c "import json,sys; r=[json.loads(l) for l in open(sys.argv[1])]; assert [(x[\"name\"], x[\"rc\"]) for x in r] == [(\"ok-hook\",0),(\"bad-hook\",4)] and all(x[\"maxrss_kb\"] > 0 and x[\"wall_s\"] >= 0 for x in r)" "${TMP_DIR}/hooks.jsonl"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "hookstat should pass through the exit status and record usage per hook"
+cleanup_env
+run_test "runner-parallel-bundles" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/bdebstrap" "${TMP_DIR}/out" && \
+     printf "#!/bin/sh\n# runner: parallel\nfor i in \$(seq 50); do [ -f \"\$1/b\" ] && exit 0; sleep 0.1; done; exit 1\n" > "${TMP_DIR}/bdebstrap/extract10-a" && \
+     printf "#!/bin/sh\n# runner: parallel\ntouch \"\$1/b\"\n" > "${TMP_DIR}/bdebstrap/extract20-b" && \
+     printf "#!/bin/sh\n[ -f \"\$1/b\" ] && touch \"\$1/c\"\n" > "${TMP_DIR}/bdebstrap/extract30-c" && \
+     chmod +x "${TMP_DIR}"/bdebstrap/* && \
+     IGTOP="$IGTOP" SRCROOT="$TMP_DIR" IGconf_sys_hook_jobs=2 runner extract /dev/null "${TMP_DIR}/out" >/dev/null && \
+     [ -f "${TMP_DIR}/out/c" ] && \
+     printf "#!/bin/sh\n# runner: parallel\nexit 3\n" > "${TMP_DIR}/bdebstrap/extract40-d" && chmod +x "${TMP_DIR}/bdebstrap/extract40-d" && \
+     ! IGTOP="$IGTOP" SRCROOT="$TMP_DIR" IGconf_sys_hook_jobs=2 runner extract /dev/null "${TMP_DIR}/out" >/dev/null 2>&1; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Runner should run adjacent parallel-marked bundle scripts concurrently and keep unmarked ones as barriers"
+cleanup_env
+run_test "overlay-union-apply" \
+    'TMP_DIR=$(mktemp -d) && cd "$TMP_DIR" && mkdir -p a/etc/keep b/etc dest/etc && \
+     echo one > a/etc/f && echo same > a/etc/s && touch a/etc/keep/.keep && \
+     echo two > b/etc/f && echo same > b/etc/s && chmod 600 b/etc/f && ln -s f b/etc/link && \
+     echo old > dest/etc/f && echo untouched > dest/etc/u && \
+     OUT=$(overlay dest a b 2>&1) && \
+     [ "$(cat dest/etc/f)" = two ] && [ "$(stat -c %a dest/etc/f)" = 600 ] && \
+     [ "$(readlink dest/etc/link)" = f ] && [ "$(cat dest/etc/u)" = untouched ] && \
+     [ -d dest/etc/keep ] && [ ! -e dest/etc/keep/.keep ] && \
+     echo "$OUT" | grep -q "conflict etc/f: b overrides a" && \
+     ! echo "$OUT" | grep -q "conflict etc/s" && \
+     mkdir -p c d/etc/f && touch c/etc d/etc/f/g && ! overlay dest a c 2>/dev/null && \
+     OUT=$(overlay dest b d 2>&1) && [ -f dest/etc/f/g ] && \
+     echo "$OUT" | grep -q "conflict etc/f: directory in d replaces b"; RESULT=$?; \
+     cd / && rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Overlay should apply the union of overlays in order and report conflicting content"
+cleanup_env
+run_test "load-env-array" \
+    'TMP_ENV=$(mktemp) && \
+     printf "%s\n" "# comment" "" "IGconf_a_one=\"first value\"" "IGconf_a_two=x=y" "IG_ENABLE_HOST_ZSTD=y" > "$TMP_ENV" && \
+     ( source "${IGTOP}/lib/common.sh" && source "${IGTOP}/lib/tools.sh" && declare -A cfg && \
+       load_env "$TMP_ENV" cfg && [ "${cfg[IGconf_a_one]}" = "first value" ] && [ "${cfg[IGconf_a_two]}" = "x=y" ] && \
+       [ "${#cfg[@]}" -eq 3 ] && [ "$(collect_build_deps cfg)" = " zstd" ] && \
+       echo "not an assignment" >> "$TMP_ENV" && ! load_env "$TMP_ENV" cfg 2>/dev/null ); RESULT=$?; \
+     rm -f "$TMP_ENV"; \
+     exit $RESULT' \
+    0 \
+    "load_env should read an env file into an associative array and reject malformed lines"
+cleanup_env
+run_test "pipeline-build-plan" \
+    'TMP_ENV=$(mktemp) && TMP_OUT=$(mktemp) && TMP_PLAN=$(mktemp) && TMP_DIR=$(mktemp -d) && \
+     cat > "${TMP_DIR}/plan-base.yaml" << "EOF" &&
+# METABEGIN
+# X-Env-Layer-Name: test-plan-base
+# X-Env-Layer-Desc: Layer without an mmdebstrap mapping
+# X-Env-Layer-Version: 1.0.0
+# X-Env-Layer-Category: test
+# METAEND
+EOF
+     cat > "${TMP_DIR}/plan-mm.yaml" << "EOF" &&
+# METABEGIN
+# X-Env-Layer-Name: test-plan-mm
+# X-Env-Layer-Desc: Layer with an mmdebstrap mapping and an overlay
+# X-Env-Layer-Version: 2.0.0
+# X-Env-Layer-Category: test
+# X-Env-Layer-Requires: test-plan-base
+# METAEND
+---
+mmdebstrap:
+  packages:
+    - hello
+EOF
+     mkdir "${TMP_DIR}/plan-mm.rootfs-overlay" && \
+     make_pipeline_env "$TMP_ENV" && \
+     ig pipeline --env-in "$TMP_ENV" --layers test-plan-mm --path "$TMP_DIR" \
+        --env-out "$TMP_OUT" --build-plan-out "$TMP_PLAN" >/dev/null && \
+     SHA=$(sha256sum "${TMP_DIR}/plan-mm.yaml" | cut -d" " -f1) && \
+     grep -qxP "test-plan-base\t1.0.0\t${TMP_DIR}/plan-base.yaml\t${TMP_DIR}/plan-base.yaml\tn\t-\t[0-9a-f]{64}" "$TMP_PLAN" && \
+     grep -qxP "test-plan-mm\t2.0.0\t${TMP_DIR}/plan-mm.yaml\t${TMP_DIR}/plan-mm.yaml\ty\t${TMP_DIR}/plan-mm.rootfs-overlay\t${SHA}" "$TMP_PLAN"; RESULT=$?; \
+     rm -rf "$TMP_ENV" "$TMP_OUT" "$TMP_PLAN" "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Pipeline build plan should carry the mmdebstrap flag, overlay dir and file hash per layer"
+
+cleanup_env
+run_test "aptcache-prefetch-local-mirror" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/repo" "${TMP_DIR}/cache" && \
+     for p in alpha beta; do \
+        mkdir -p "${TMP_DIR}/pkg-$p/DEBIAN" && \
+        printf "Package: %s\nVersion: 1.0\nArchitecture: all\nMaintainer: t <t@example.com>\nDescription: t\n" $p \
+           > "${TMP_DIR}/pkg-$p/DEBIAN/control" || exit 1; \
+     done && \
+     echo "Depends: alpha" >> "${TMP_DIR}/pkg-beta/DEBIAN/control" && \
+     dpkg-deb -b "${TMP_DIR}/pkg-alpha" "${TMP_DIR}/repo/alpha_1.0_all.deb" >/dev/null && \
+     dpkg-deb -b "${TMP_DIR}/pkg-beta" "${TMP_DIR}/repo/beta_1.0_all.deb" >/dev/null && \
+     (cd "${TMP_DIR}/repo" && dpkg-scanpackages . > Packages 2>/dev/null) && \
+     cat > "${TMP_DIR}/layer.yaml" << EOF &&
+mmdebstrap:
+  variant: custom
+  mirrors:
+    - deb [trusted=yes] file://${TMP_DIR}/repo ./
+  packages:
+    - beta
+EOF
+     printf "# header\nt\t1.0\t%s\t%s\ty\t-\tsha\n" "${TMP_DIR}/layer.yaml" "${TMP_DIR}/layer.yaml" > "${TMP_DIR}/build.plan" && \
+     ig aptcache prefetch --plan "${TMP_DIR}/build.plan" --cache "${TMP_DIR}/cache" --jobs 2 | grep -q "0 cached, 2 fetched" && \
+     cmp -s "${TMP_DIR}/repo/alpha_1.0_all.deb" "${TMP_DIR}/cache/alpha_1.0_all.deb" && \
+     cmp -s "${TMP_DIR}/repo/beta_1.0_all.deb" "${TMP_DIR}/cache/beta_1.0_all.deb" && \
+     ig aptcache prefetch --plan "${TMP_DIR}/build.plan" --cache "${TMP_DIR}/cache" | grep -q "2 cached, 0 fetched"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Apt cache prefetch should resolve dependencies from the layer mirrors and fetch missing debs once"
+
+cleanup_env
+run_test "aptcache-index-incremental" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/cache" && \
+     for p in alpha beta gamma; do \
+        mkdir -p "${TMP_DIR}/pkg-$p/DEBIAN" && \
+        printf "Package: %s\nVersion: 1.0\nArchitecture: all\nMaintainer: t <t@example.com>\nDescription: t\n" $p \
+           > "${TMP_DIR}/pkg-$p/DEBIAN/control" && \
+        dpkg-deb -b "${TMP_DIR}/pkg-$p" "${TMP_DIR}/$p.deb" >/dev/null || exit 1; \
+     done && \
+     cp "${TMP_DIR}/alpha.deb" "${TMP_DIR}/cache/alpha_1.0_all.deb" && \
+     cp "${TMP_DIR}/beta.deb" "${TMP_DIR}/cache/beta_1.0_all.deb" && \
+     ig aptcache index --cache "${TMP_DIR}/cache" | grep -q "index 2 packages (2 added, 0 removed)" && \
+     ig aptcache index --cache "${TMP_DIR}/cache" | grep -q "index 2 packages (0 added, 0 removed)" && \
+     cp "${TMP_DIR}/gamma.deb" "${TMP_DIR}/cache/gamma_1.0_all.deb" && \
+     rm "${TMP_DIR}/cache/alpha_1.0_all.deb" && \
+     ig aptcache index --cache "${TMP_DIR}/cache" | grep -q "index 2 packages (1 added, 1 removed)" && \
+     grep -qx "Filename: ./gamma_1.0_all.deb" "${TMP_DIR}/cache/Packages" && \
+     ! grep -q "alpha" "${TMP_DIR}/cache/Packages" && \
+     grep -qx "Origin: rpi-image-gen" "${TMP_DIR}/cache/Release" && \
+     (cd "${TMP_DIR}/cache" && sed -n "s/^ \([0-9a-f]\{64\}\) [0-9]* \(.*\)$/\1  \2/p" Release | sha256sum --quiet -c -); RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Apt cache index should only parse new debs, drop removed ones and keep Release hashes in step"
+
+cleanup_env
+run_test "cache-evict-lru" \
+    'TMP_DIR=$(mktemp -d) && C="${TMP_DIR}/cache" && mkdir -p "$C/pip-cache/ab" "$C/pip-wheels" && \
+     head -c 4096 /dev/zero > "$C/pip-wheels/built.whl" && touch -d "4 days ago" "$C/pip-wheels/built.whl" && \
+     head -c 4096 /dev/zero > "$C/old.tar.gz" && touch -d "3 days ago" "$C/old.tar.gz" && \
+     head -c 4096 /dev/zero > "$C/pip-cache/ab/mid.whl" && touch -d "2 days ago" "$C/pip-cache/ab/mid.whl" && \
+     head -c 4096 /dev/zero > "$C/new.tar.gz" && \
+     ig cache evict --root "$C" --max-size 10K | grep -q "evicted 1 file" && \
+     [ ! -e "$C/old.tar.gz" ] && [ -e "$C/pip-cache/ab/mid.whl" ] && [ -e "$C/new.tar.gz" ] && \
+     flock -s "$C/.igcache/lock" ig cache evict --root "$C" --max-size 1K | grep -q "in use" && \
+     [ -e "$C/pip-cache/ab/mid.whl" ] && \
+     ig cache evict --root "$C" --max-size 5K | grep -q "evicted 1 file" && \
+     [ ! -d "$C/pip-cache/ab" ] && [ -d "$C/pip-cache" ] && [ -e "$C/new.tar.gz" ] && \
+     [ -e "$C/pip-wheels/built.whl" ] && \
+     ig cache stat --root "$C" | grep -q "1 files"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Cache eviction should remove least recently used files to budget, keep built wheels and skip while the cache is referenced"
+
+cleanup_env
+run_test "deploy-assets-zstd" \
+    'TMP_DIR=$(mktemp -d) && \
+     head -c 300000 /dev/urandom > "${TMP_DIR}/root.img" && truncate -s 8M "${TMP_DIR}/data.img" && \
+     echo "{}" > "${TMP_DIR}/image.json" && \
+     "${IGTOP}/bin/deploy-assets" --level 5 --threads 2 --long 27 "${TMP_DIR}/out" \
+        "${TMP_DIR}/root.img" "${TMP_DIR}/data.img" "${TMP_DIR}/image.json" "${TMP_DIR}/absent" > "${TMP_DIR}/log" && \
+     grep -q "Installed 3/3 assets" "${TMP_DIR}/log" && \
+     grep -q "data.img.zst: .* MB/s" "${TMP_DIR}/log" && \
+     for f in root.img data.img image.json; do \
+        zstd -q -dc --long=27 "${TMP_DIR}/out/$f.zst" | cmp -s - "${TMP_DIR}/$f" || exit 1; \
+     done; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Deploy assets should compress every present asset concurrently with the configured zstd options"
+
+cleanup_env
+run_test "deploy-assets-thread-share" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/bin" && \
+     printf "#!/bin/sh\necho \"\$*\" >> \"%s/zstd.args\"\nexec %s \"\$@\"\n" "$TMP_DIR" "$(command -v zstd)" > "${TMP_DIR}/bin/zstd" && \
+     chmod +x "${TMP_DIR}/bin/zstd" && \
+     for f in a b; do head -c 100000 /dev/urandom > "${TMP_DIR}/$f.img"; done && \
+     PATH="${TMP_DIR}/bin:$PATH" "${IGTOP}/bin/deploy-assets" --jobs 2 "${TMP_DIR}/out" \
+        "${TMP_DIR}/a.img" "${TMP_DIR}/b.img" > /dev/null && \
+     T=$(( $(nproc) > 1 ? $(nproc) / 2 : 1 )) && \
+     [ "$(grep -c -- " -T${T} " "${TMP_DIR}/zstd.args")" -eq 2 ] && \
+     PATH="${TMP_DIR}/bin:$PATH" "${IGTOP}/bin/deploy-assets" --jobs 2 --threads 3 "${TMP_DIR}/out" \
+        "${TMP_DIR}/a.img" > /dev/null && \
+     grep -q -- " -T3 " "${TMP_DIR}/zstd.args"; RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Deploy assets should divide the CPUs between concurrent zstd jobs unless threads are set"
+
+cleanup_env
+run_test "deploy-assets-manifest" \
+    'TMP_DIR=$(mktemp -d) && \
+     head -c 200000 /dev/urandom > "${TMP_DIR}/root.img" && truncate -s 4M "${TMP_DIR}/data.img" && \
+     "${IGTOP}/bin/deploy-assets" --compression none --sha1 --version 1.2.3 \
+        --manifest "${TMP_DIR}/out/deployed.json" "${TMP_DIR}/out" \
+        "${TMP_DIR}/root.img" "${TMP_DIR}/data.img" >/dev/null && \
+     cmp -s "${TMP_DIR}/root.img" "${TMP_DIR}/out/root.img" && \
+     cmp -s "${TMP_DIR}/data.img" "${TMP_DIR}/out/data.img" && \
+     [ "$(du -k "${TMP_DIR}/out/data.img" | cut -f1)" -lt 1024 ] && \
+     python3 - "${TMP_DIR}/out" << "EOF"
+import hashlib, json, os, sys
+out = sys.argv[1]
+m = json.load(open(os.path.join(out, "deployed.json")))
+assert m["deployment_info"]["version"] == "1.2.3"
+assert [f["name"] for f in m["files"]] == ["data.img", "root.img"]
+for f in m["files"]:
+    data = open(os.path.join(out, f["name"]), "rb").read()
+    assert f["size"] == len(data)
+    assert f["sha256"] == hashlib.sha256(data).hexdigest()
+    assert f["sha1"] == hashlib.sha1(data).hexdigest()
+    assert f["mime_type"] == "application/octet-stream"
+EOF
+     RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Deploy assets should hash files while writing them, keep holes and write a JSON manifest"
+
+run_test "genimage-run-deps" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/bin" "${TMP_DIR}/out" && \
+     cat > "${TMP_DIR}/bin/genimage" << "EOF" &&
+#!/bin/bash
+while [ $# -gt 0 ]; do
+   case $1 in
+      --tmppath) tmp=$2; shift ;;
+      --config) conf=$2; shift ;;
+   esac
+   shift
+done
+[ -e "$tmp" ] && exit 2
+mkdir -p "$tmp"
+name=$(basename "$conf")
+echo "start $name $tmp" >> "$LOG"
+sleep 0.3
+echo "end $name" >> "$LOG"
+! grep -q FAIL "$conf"
+EOF
+     chmod +x "${TMP_DIR}/bin/genimage" && \
+     printf "image a.img {\n  hdimage {}\n}\n" > "${TMP_DIR}/out/genimage1.cfg" && \
+     printf "# FAIL\nimage b.img {\n  hdimage {}\n}\n" > "${TMP_DIR}/out/genimage2.cfg" && \
+     printf "image c.img {\n  hdimage {}\n  partition p { image = \"a.img\" }\n}\n" > "${TMP_DIR}/out/genimage3.cfg" && \
+     printf "image d.img {\n  hdimage {}\n  partition p { image = \"b.img\" }\n}\n" > "${TMP_DIR}/out/genimage4.cfg" && \
+     ! LOG="${TMP_DIR}/log" PATH="${TMP_DIR}/bin:$PATH" "${IGTOP}/bin/genimage-run" --jobs 2 \
+        --rootpath "$TMP_DIR" --tmpdir "${TMP_DIR}/tmp" \
+        --inputpath "${TMP_DIR}/out" --outputpath "${TMP_DIR}/out" \
+        "${TMP_DIR}"/out/genimage*.cfg > "${TMP_DIR}/stdout" 2> "${TMP_DIR}/stderr" && \
+     grep -q "genimage: 2/4 configs" "${TMP_DIR}/stdout" && \
+     grep -q "genimage2.cfg: genimage failed" "${TMP_DIR}/stderr" && \
+     grep -q "genimage4.cfg: not run" "${TMP_DIR}/stderr" && \
+     ! grep -q "genimage4.cfg" "${TMP_DIR}/log" && \
+     [ "$(sed -n 2p "${TMP_DIR}/log" | cut -d" " -f1)" = start ] && \
+     [ "$(grep -n "start genimage3.cfg" "${TMP_DIR}/log" | cut -d: -f1)" -gt \
+       "$(grep -n "end genimage1.cfg" "${TMP_DIR}/log" | cut -d: -f1)" ] && \
+     [ "$(grep "^start" "${TMP_DIR}/log" | cut -d" " -f3 | sort -u | wc -l)" -eq 3 ]; \
+     RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "genimage-run should run independent configs concurrently and skip dependants of failed ones"
+
+run_test "imagestamp-reuse" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/rootfs/etc" "${TMP_DIR}/out" && \
+     echo hello > "${TMP_DIR}/rootfs/etc/hostname" && ln -s hostname "${TMP_DIR}/rootfs/etc/link" && \
+     echo "#!/bin/sh" > "${TMP_DIR}/setup.sh" && \
+     printf "image a.img {\n  exec-pre = \"%s\"\n}\n" "${TMP_DIR}/setup.sh" > "${TMP_DIR}/out/genimage.cfg" && \
+     check() { "${IGTOP}/bin/ig" imagestamp check --rootfs "${TMP_DIR}/rootfs" --outdir "${TMP_DIR}/out" "$@"; } && \
+     regen() { local why=$1; shift; out=$(check "$@"); [ $? -eq 1 ] && echo "$out" | grep -q "$why"; } && \
+     generate() { date +%N > "${TMP_DIR}/out/a.img" && "${IGTOP}/bin/ig" imagestamp record --outdir "${TMP_DIR}/out" | grep -q "recorded 1 artefact"; } && \
+     regen "no previous image" && generate && \
+     check | grep -q "reusing 1 artefact" && \
+     touch "${TMP_DIR}/rootfs/etc/hostname" && check >/dev/null && \
+     IGconf_image_foo=bar regen "IGconf_image_foo changed" && \
+     regen "no previous image" && generate && \
+     IGconf_image_genimage_jobs=4 check >/dev/null && \
+     echo "# changed" >> "${TMP_DIR}/setup.sh" && \
+     regen "setup.sh changed" && generate && check >/dev/null && \
+     echo goodbye > "${TMP_DIR}/rootfs/etc/hostname" && \
+     regen "rootfs changed" && generate && check >/dev/null && \
+     regen "regeneration forced" --force && generate && check >/dev/null && \
+     printf "#!/bin/sh\ntouch \"%s/ran\"\n" "$TMP_DIR" > "${TMP_DIR}/post-image.sh" && chmod +x "${TMP_DIR}/post-image.sh" && \
+     [ "$(IGTOP="$IGTOP" SRCROOT="$TMP_DIR" runner --list post-image /dev/null | tail -n 1)" = "${TMP_DIR}/post-image.sh" ] && \
+     [ ! -e "${TMP_DIR}/ran" ] && \
+     regen "post-image.sh changed" --input "${TMP_DIR}/post-image.sh" && generate && \
+     check --input "${TMP_DIR}/post-image.sh" >/dev/null && \
+     echo "# changed" >> "${TMP_DIR}/post-image.sh" && \
+     regen "post-image.sh changed" --input "${TMP_DIR}/post-image.sh" && generate && \
+     IGconf_sys_cachedir=/elsewhere check --input "${TMP_DIR}/post-image.sh" >/dev/null && \
+     IGconf_linux_page_size=16k regen "IGconf_linux_page_size changed" --input "${TMP_DIR}/post-image.sh" && generate && \
+     IGconf_linux_page_size=16k check --input "${TMP_DIR}/post-image.sh" >/dev/null && \
+     regen "IGconf_linux_page_size changed" --input "${TMP_DIR}/post-image.sh" && generate && \
+     echo corrupt >> "${TMP_DIR}/out/a.img" && \
+     regen "a.img missing or modified" --input "${TMP_DIR}/post-image.sh"; \
+     RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "Image stamps should reuse artefacts until the rootfs, configs, referenced files, hooks or variables change"
+
+run_test "img2sparse-holes" \
+    'TMP_DIR=$(mktemp -d) && mkdir -p "${TMP_DIR}/tree" && \
+     head -c 3000000 /dev/urandom > "${TMP_DIR}/tree/data" && \
+     truncate -s 64M "${TMP_DIR}/raw.img" && mkfs.ext4 -q -d "${TMP_DIR}/tree" "${TMP_DIR}/raw.img" && \
+     head -c 1000 /dev/urandom >> "${TMP_DIR}/raw.img" && \
+     "${IGTOP}/bin/img2sparse" --max-chunk 1048576 "${TMP_DIR}/raw.img" "${TMP_DIR}/raw.sparse" > /dev/null && \
+     "${IGTOP}/bin/img2sparse" --zstd --max-chunk 1048576 "${TMP_DIR}/raw.img" "${TMP_DIR}/raw.sparse.zst" > /dev/null && \
+     zstd -q -d -c "${TMP_DIR}/raw.sparse.zst" > "${TMP_DIR}/stream.sparse" && \
+     python3 - "$TMP_DIR" << "EOF"
+import os, struct, sys
+top = sys.argv[1]
+raw = open(os.path.join(top, "raw.img"), "rb").read()
+for name in ("raw.sparse", "stream.sparse"):
+    with open(os.path.join(top, name), "rb") as f:
+        magic, major, _, hsz, csz, blk, blocks, nchunks, _ = struct.unpack("<IHHHHIIII", f.read(28))
+        assert (magic, major, blk) == (0xed26ff3a, 1, 4096)
+        assert blocks == -(-len(raw) // 4096)
+        out = bytearray(blocks * 4096)
+        pos = holes = 0
+        for _ in range(nchunks):
+            ctype, _, n, total = struct.unpack("<HHII", f.read(csz))
+            if ctype == 0xcac1:
+                assert total == csz + n * 4096 and n <= 256
+                out[pos:pos + n * 4096] = f.read(n * 4096)
+            else:
+                assert ctype == 0xcac3 and total == csz
+                holes += n
+            pos += n * 4096
+        assert pos == blocks * 4096 and f.read() == b""
+    assert bytes(out[:len(raw)]) == raw and not any(out[len(raw):])
+    # Most of a fresh 64M filesystem is holes, never stored
+    assert holes * 4096 > 32 << 20 and os.path.getsize(os.path.join(top, name)) < 16 << 20
+EOF
+     RESULT=$?; \
+     rm -rf "$TMP_DIR"; \
+     exit $RESULT' \
+    0 \
+    "img2sparse should skip holes as DONT_CARE and stream the same image through zstd"
+
 print_header "ENVIRONMENT VARIABLE DEPENDENCY TESTS"
 
 # Test environment variable dependency apply-env